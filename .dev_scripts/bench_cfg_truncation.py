@@ -0,0 +1,81 @@
+"""
+Measures what --cfg_truncation buys and costs. For each sampler and
+truncation fraction, generates the same seeds and reports the seconds per
+image, and how far the images drift from the untruncated ones: the mean
+absolute pixel difference (0-255) and the PSNR in dB.
+
+    python .dev_scripts/bench_cfg_truncation.py --samplers ddim k_lms --truncations 0 0.1 0.2 0.3
+
+Needs the model weights. With --outdir, the images are also written there to
+be compared by eye.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+
+def image_distance(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    mae = np.abs(a - b).mean()
+    mse = ((a - b) ** 2).mean()
+    psnr = float('inf') if mse == 0 else 10 * np.log10(255.0**2 / mse)
+    return mae, psnr
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prompt', default='a photograph of an astronaut riding a horse')
+    parser.add_argument('--samplers', nargs='+', default=['ddim', 'plms', 'k_lms', 'k_euler_a'])
+    parser.add_argument('--truncations', type=float, nargs='+', default=[0.0, 0.1, 0.2, 0.3, 0.5])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[42, 43, 44])
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--cfg_scale', type=float, default=7.5)
+    parser.add_argument('--weights', default='models/ldm/stable-diffusion-v1/model.ckpt')
+    parser.add_argument('--config', default='configs/stable-diffusion/v1-inference.yaml')
+    parser.add_argument('--outdir', default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    from ldm.generate import Generate
+
+    t2i = Generate(weights=args.weights, config=args.config, steps=args.steps, cfg_scale=args.cfg_scale)
+    t2i.load_model()
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    rows = []
+    for sampler in args.samplers:
+        reference = {}
+        # warm up, so the first timing doesn't include setting up the sampler
+        t2i.prompt2image(args.prompt, seed=args.seeds[0], steps=2, sampler_name=sampler)
+        for truncation in [0.0] + [t for t in args.truncations if t != 0.0]:
+            seconds = 0.0
+            mae = psnr = 0.0
+            for seed in args.seeds:
+                tic = time.time()
+                [[image, _]] = t2i.prompt2image(
+                    args.prompt, seed=seed, sampler_name=sampler, cfg_truncation=truncation,
+                )
+                seconds += time.time() - tic
+                if truncation == 0.0:
+                    reference[seed] = image
+                else:
+                    d_mae, d_psnr = image_distance(reference[seed], image)
+                    mae  += d_mae
+                    psnr += d_psnr
+                if args.outdir:
+                    image.save(os.path.join(args.outdir, f'{sampler}.{seed}.truncation-{truncation}.png'))
+            n = len(args.seeds)
+            rows.append((sampler, truncation, seconds / n, mae / n, psnr / n if truncation else float('inf')))
+
+    print(f'{"sampler":>10} {"truncation":>10} {"s/image":>8} {"mean |diff|":>11} {"PSNR dB":>8}')
+    for sampler, truncation, seconds, mae, psnr in rows:
+        print(f'{sampler:>10} {truncation:>10.2f} {seconds:>8.2f} {mae:>11.2f} {psnr:>8.2f}')
@@ -0,0 +1,119 @@
+"""
+Measures the per-step overhead of the DDIM and PLMS samplers, leaving out the
+UNet. The model is a stand-in whose apply_model returns a fixed tensor, so
+what's timed is the sampler's own bookkeeping and update arithmetic.
+
+    python .dev_scripts/bench_sampler_overhead.py --steps 50 --batch_size 1 4 --device cuda
+
+For comparison, --legacy also times the DDIM update as it was written before
+the coefficient tables: four torch.full() tensors built for every step.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+
+
+class StandInModel:
+    '''Just enough of LatentDiffusion for the samplers to run'''
+    parameterization = 'eps'
+
+    def __init__(self, device, timesteps=1000):
+        betas = make_beta_schedule('linear', timesteps, linear_start=0.00085, linear_end=0.0120)
+        alphas_cumprod = torch.cumprod(1.0 - torch.tensor(betas), dim=0)
+        self.num_timesteps      = timesteps
+        self.device             = torch.device(device)
+        self.betas              = torch.tensor(betas, dtype=torch.float32, device=device)
+        self.alphas_cumprod     = alphas_cumprod.to(torch.float32).to(device)
+        self.alphas_cumprod_prev = torch.cat([torch.ones(1), alphas_cumprod[:-1]]).to(torch.float32).to(device)
+        self.e_t = None
+
+    def apply_model(self, x, t, c):
+        if self.e_t is None or self.e_t.shape != x.shape:
+            self.e_t = torch.randn_like(x) * 0.1
+        return self.e_t
+
+
+def legacy_ddim_update(sampler, x, e_t, index):
+    b, device = x.shape[0], x.device
+    a_t = torch.full((b, 1, 1, 1), sampler.ddim_alphas[index], device=device)
+    a_prev = torch.full((b, 1, 1, 1), sampler.ddim_alphas_prev[index], device=device)
+    sigma_t = torch.full((b, 1, 1, 1), sampler.ddim_sigmas[index], device=device)
+    sqrt_one_minus_at = torch.full((b, 1, 1, 1), sampler.ddim_sqrt_one_minus_alphas[index], device=device)
+    pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+    dir_xt = (1.0 - a_prev - sigma_t**2).sqrt() * e_t
+    noise = sigma_t * torch.randn(x.shape, device=device)
+    return a_prev.sqrt() * pred_x0 + dir_xt + noise, pred_x0
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_sampler(name, sampler_class, model, args, batch_size):
+    sampler = sampler_class(model, device=args.device)
+    shape   = (4, args.latent, args.latent)
+    c       = torch.zeros(batch_size, 77, 768, device=args.device)
+    x_T     = torch.randn(batch_size, *shape, device=args.device)
+    sample  = lambda: sampler.sample(
+        S=args.steps, batch_size=batch_size, shape=shape, conditioning=c,
+        eta=args.eta if name == 'ddim' else 0.0, x_T=x_T, verbose=False,
+        unconditional_guidance_scale=1.0,
+    )
+    sample()   # warm up
+    synchronize(args.device)
+    tic = time.perf_counter()
+    for _ in range(args.repeats):
+        sample()
+    synchronize(args.device)
+    return (time.perf_counter() - tic) / (args.repeats * args.steps)
+
+
+def time_legacy(model, args, batch_size):
+    sampler = DDIMSampler(model, device=args.device)
+    sampler.make_schedule(ddim_num_steps=args.steps, ddim_eta=args.eta, verbose=False)
+    x   = torch.randn(batch_size, 4, args.latent, args.latent, device=args.device)
+    e_t = model.apply_model(x, None, None)
+    legacy_ddim_update(sampler, x, e_t, 0)
+    synchronize(args.device)
+    tic = time.perf_counter()
+    for _ in range(args.repeats):
+        for index in reversed(range(args.steps)):
+            x, _ = legacy_ddim_update(sampler, x, e_t, index)
+    synchronize(args.device)
+    return (time.perf_counter() - tic) / (args.repeats * args.steps)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--latent', type=int, default=64, help='latent size; 64 is a 512x512 image')
+    parser.add_argument('--eta', type=float, default=0.0, help='ddim eta; noise is only drawn when it is not 0')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--legacy', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args  = parse_args()
+    model = StandInModel(args.device)
+    print(f'{"sampler":>8} {"batch":>6} {"ms/step":>8}')
+    for batch_size in args.batch_size:
+        results = [
+            ('ddim', time_sampler('ddim', DDIMSampler, model, args, batch_size)),
+            ('plms', time_sampler('plms', PLMSSampler, model, args, batch_size)),
+        ]
+        if args.legacy:
+            results.append(('legacy', time_legacy(model, args, batch_size)))
+        for name, seconds in results:
+            print(f'{name:>8} {batch_size:>6} {seconds * 1000:>8.3f}')
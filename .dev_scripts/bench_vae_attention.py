@@ -0,0 +1,91 @@
+"""
+Measures the peak memory of the autoencoder's mid-block attention (AttnBlock)
+at a range of latent sizes, for each attention backend. Every measurement runs
+in a fresh subprocess so that peak RSS belongs to that run alone.
+
+    python .dev_scripts/bench_vae_attention.py --sizes 64 128 256 --backends einsum auto
+
+A latent of 64 is a 512x512 image; 128 is 1024x1024 and 256 is 2048x2048.
+Runs on the CPU unless --device is given.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def measure(size, backend, device, channels, budget_gb):
+    import torch
+    from ldm.modules.attention import set_attention_memory_budget
+    from ldm.modules.diffusionmodules.model import AttnBlock
+
+    if budget_gb is not None:
+        set_attention_memory_budget(int(budget_gb * 2**30))
+    torch.manual_seed(0)
+    block = AttnBlock(channels).to(device).eval()
+    x = torch.randn(1, channels, size, size, device=device)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tic = time.time()
+    with torch.no_grad():
+        block(x, backend=None if backend == 'auto' else backend)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    elapsed = time.time() - tic
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        'size':          size,
+        'backend':       backend,
+        'seconds':       round(elapsed, 2),
+        'peak_rss_gb':   round(peak * unit / 2**30, 2),
+        'added_rss_gb':  round((peak - baseline) * unit / 2**30, 2),
+    }
+    if device.startswith('cuda'):
+        result['peak_cuda_gb'] = round(torch.cuda.max_memory_allocated() / 2**30, 2)
+    print(json.dumps(result))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 96, 128, 192, 256])
+    parser.add_argument('--backends', nargs='+', default=['einsum', 'sliced', 'flash', 'auto'])
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--budget_gb', type=float, default=None,
+                        help='attention memory budget; defaults to half of free memory')
+    parser.add_argument('--timeout', type=int, default=1800)
+    parser.add_argument('--_run', nargs=2, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args._run:
+        measure(int(args._run[0]), args._run[1], args.device, args.channels, args.budget_gb)
+        sys.exit(0)
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    print(f'{"latent":>8} {"backend":>8} {"seconds":>8} {"peak RSS GB":>12} {"added GB":>9}')
+    for size in args.sizes:
+        for backend in args.backends:
+            cmd = [sys.executable, __file__, '--_run', str(size), backend,
+                   '--device', args.device, '--channels', str(args.channels)]
+            if args.budget_gb is not None:
+                cmd += ['--budget_gb', str(args.budget_gb)]
+            try:
+                run = subprocess.run(cmd, cwd=root, capture_output=True, text=True,
+                                     timeout=args.timeout, env={**os.environ, 'PYTHONPATH': root})
+            except subprocess.TimeoutExpired:
+                print(f'{size:>8} {backend:>8} {"timeout":>8}')
+                continue
+            lines = [l for l in run.stdout.splitlines() if l.startswith('{')]
+            if run.returncode != 0 or not lines:
+                error = (run.stderr.strip().splitlines() or ['failed'])[-1]
+                print(f'{size:>8} {backend:>8} {"failed":>8}  {error[:60]}')
+                continue
+            r = json.loads(lines[-1])
+            print(f'{size:>8} {backend:>8} {r["seconds"]:>8} {r["peak_rss_gb"]:>12} {r["added_rss_gb"]:>9}')
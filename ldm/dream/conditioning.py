@@ -7,33 +7,163 @@ Useful function exports:
 get_uc_and_c()                  get the conditioned and unconditioned latent
 split_weighted_subpromopts()    split subprompts, normalize and weight them
 log_tokenization()              print out colour-coded tokens and warn if truncated
+conditioning_cache              LRU cache of subprompt embeddings used by get_uc_and_c()
 
 '''
 import re
+import threading
+import weakref
 import torch
+from collections import OrderedDict
 
-def get_uc_and_c(prompt, model, log_tokens=False, skip_normalize=False):
-    uc = model.get_learned_conditioning([''])
+class ConditioningCache:
+    '''
+    LRU cache of the learned conditioning of prompt text, bounded both by the number
+    of entries and by their total size in bytes. The unconditional ('') embedding is
+    kept outside the LRU so that it is only computed once per model. Everything is
+    dropped when the cache is used with a different model or when the terms loaded
+    into the model's EmbeddingManager change.
+    '''
+    def __init__(self, max_entries=256, max_bytes=64 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.entries     = OrderedDict()
+        self.bytes       = 0
+        self.uc          = None
+        self.hits        = 0
+        self.misses      = 0
+        self.model_ref   = None
+        self.fingerprint = None
+        self.lock        = threading.Lock()
+
+    def embed(self, model, texts) -> list:
+        '''Returns the learned conditioning of each of texts, encoding only the ones not cached'''
+        with self.lock:
+            self._validate(model)
+            found = [self._lookup(text) for text in texts]
+        missing = list(dict.fromkeys(
+            text for text, embedding in zip(texts, found) if embedding is None
+        ))
+        encoded = dict(zip(missing, self._encode(model, missing)))
+        with self.lock:
+            if self._valid_for(model):
+                for text, embedding in encoded.items():
+                    self._insert(text, embedding)
+        return [
+            embedding if embedding is not None else encoded[text]
+            for text, embedding in zip(texts, found)
+        ]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.uc    = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits':    self.hits,
+                'misses':  self.misses,
+                'entries': len(self.entries) + (self.uc is not None),
+                'bytes':   self.bytes,
+            }
+
+    # All of the texts are tokenized and run through the text encoder together as
+    # one batch, then split back into single rows. The rows are cloned so that
+    # each cache entry owns (and is accounted for) only its own storage.
+    @torch.no_grad()
+    def _encode(self, model, texts):
+        if not texts:
+            return []
+        embeddings = model.get_learned_conditioning(texts)
+        return [embedding.unsqueeze(0).clone() for embedding in embeddings]
+
+    def _lookup(self, text):
+        if text == '':
+            embedding = self.uc
+        else:
+            embedding = self.entries.get(text)
+            if embedding is not None:
+                self.entries.move_to_end(text)
+        if embedding is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return embedding
+
+    def _insert(self, text, embedding):
+        if text == '':
+            self.uc = embedding
+            return
+        if text in self.entries:
+            return
+        size = embedding.numel() * embedding.element_size()
+        if size > self.max_bytes:
+            return
+        self.entries[text] = embedding
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+
+    def _validate(self, model):
+        if self._valid_for(model):
+            return
+        self.entries.clear()
+        self.bytes       = 0
+        self.uc          = None
+        self.model_ref   = weakref.ref(model)
+        self.fingerprint = self._fingerprint(model)
 
+    def _valid_for(self, model):
+        return (
+            self.model_ref is not None
+            and self.model_ref() is model
+            and self.fingerprint == self._fingerprint(model)
+        )
+
+    # Identifies the current contents of the model's EmbeddingManager. Loading
+    # new terms replaces or adds parameters, and modifying them in place bumps
+    # their version counter, so either one changes the fingerprint.
+    def _fingerprint(self, model):
+        manager = getattr(model, 'embedding_manager', None)
+        if manager is None:
+            return None
+        if getattr(manager, 'progressive_words', False):
+            # embeddings depend on how many times the manager has been called
+            return object()
+        return tuple(
+            (key, id(param), param._version)
+            for key, param in manager.string_to_param_dict.items()
+        )
+
+conditioning_cache = ConditioningCache()
+
+def get_uc_and_c(prompt, model, log_tokens=False, skip_normalize=False):
     # get weighted sub-prompts
     weighted_subprompts = split_weighted_subprompts(
         prompt, skip_normalize
     )
 
     if len(weighted_subprompts) > 1:
+        for subprompt, weight in weighted_subprompts:
+            log_tokenization(subprompt, model, log_tokens)
+        uc, *embeddings = conditioning_cache.embed(
+            model, [''] + [subprompt for subprompt, weight in weighted_subprompts]
+        )
         # i dont know if this is correct.. but it works
         c = torch.zeros_like(uc)
         # normalize each "sub prompt" and add it
-        for subprompt, weight in weighted_subprompts:
-            log_tokenization(subprompt, model, log_tokens)
+        for embedding, (subprompt, weight) in zip(embeddings, weighted_subprompts):
             c = torch.add(
                 c,
-                model.get_learned_conditioning([subprompt]),
+                embedding,
                 alpha=weight,
             )
     else:   # just standard 1 prompt
         log_tokenization(prompt, model, log_tokens)
-        c = model.get_learned_conditioning([prompt])
+        uc, c = conditioning_cache.embed(model, ['', prompt])
     return (uc, c)
 
 def split_weighted_subprompts(text, skip_normalize=False)->list:
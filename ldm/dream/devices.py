@@ -18,3 +18,20 @@ def choose_autocast_device(device):
         return device_type,autocast
     else:
         return 'cpu',nullcontext
+
+def choose_batch_size(device, width, height, full_precision=False, max_batch=16):
+    '''Guesses how many width x height images can be sampled at once on device'''
+    if device.type == 'cuda':
+        mem_free, _ = torch.cuda.mem_get_info(device)
+        mem_free   += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    else:
+        import psutil
+        mem_free    = psutil.virtual_memory().available
+    # The self-attention in the highest resolution UNet blocks dominates the
+    # per-image cost: classifier-free guidance doubles the batch, there are
+    # eight heads, and each head holds a (h*w/64)^2 score matrix plus its softmax.
+    tokens         = (width // 8) * (height // 8)
+    bytes_per_elem = 4 if full_precision or device.type != 'cuda' else 2
+    per_image      = 2 * 8 * tokens * tokens * bytes_per_elem * 2.5
+    # leave a quarter of the free memory for activations and the VAE decode
+    return int(max(1, min(max_batch, (mem_free * 0.75) // per_image)))
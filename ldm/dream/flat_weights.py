@@ -0,0 +1,348 @@
+'''
+Loads model weights from a flat, memory-mapped tensor file instead of a
+pickled .ckpt.
+
+The file uses the safetensors layout: an 8 byte little-endian header
+length, a JSON header giving the dtype, shape and byte range of each
+tensor, then the raw tensor data. With --mmap_weights, a .ckpt is converted
+the first time it is loaded, optionally straight to half precision. The
+copy goes beside the checkpoint, or under CACHE_DIR if that directory
+can't be written to. After that the model is
+built with its parameters on the meta device, so they take no memory and
+need no random initialization, and each parameter is then pointed at its
+bytes in the mapped file. Nothing is copied until the model is moved to
+the GPU, and pages are only read from disk when they are used.
+
+An inference snapshot goes further. It is written once, by
+scripts/export_inference_snapshot.py, and holds only the weights that
+sampling uses: EMA weights swapped in, training-only modules such as the
+loss and model_ema dropped, and every tensor already in the target dtype.
+The model config, stripped the same way, is stored in the file's metadata,
+so the snapshot loads without a separate config file.
+'''
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from torch import nn
+
+from ldm.util import instantiate_from_config
+
+DTYPES = {
+    'F64':  torch.float64,
+    'F32':  torch.float32,
+    'F16':  torch.float16,
+    'BF16': torch.bfloat16,
+    'I64':  torch.int64,
+    'I32':  torch.int32,
+    'I16':  torch.int16,
+    'I8':   torch.int8,
+    'U8':   torch.uint8,
+    'BOOL': torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+# numpy has no bfloat16, so those tensors are written as same-sized integers
+_WRITE_AS = {torch.bfloat16: torch.int16}
+
+
+# one model is built on the meta device at a time, and only the thread
+# building it is affected
+_meta_lock  = threading.Lock()
+_meta_local = threading.local()
+
+# where checkpoints in read-only directories are converted to
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'stable-diffusion', 'flat-weights')
+
+
+def flat_weights_path(ckpt, half=False):
+    '''
+    The flat weights file that ckpt is converted to: beside it if one is
+    already there or its directory is writable, otherwise in CACHE_DIR
+    '''
+    base   = os.path.splitext(ckpt)[0]
+    beside = f'{base}-fp16.safetensors' if half else f'{base}.safetensors'
+    if os.path.exists(beside) or os.access(os.path.dirname(os.path.abspath(ckpt)), os.W_OK):
+        return beside
+    # checkpoints are often all called model.ckpt, so the name includes where it is
+    digest = hashlib.sha1(os.path.abspath(ckpt).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(CACHE_DIR, f'{os.path.basename(base)}-{digest}{beside[len(base):]}')
+
+
+def inference_snapshot_path(ckpt, half=False):
+    '''The inference snapshot that scripts/export_inference_snapshot.py writes for ckpt'''
+    base = os.path.splitext(ckpt)[0]
+    return f'{base}-inference-fp16.safetensors' if half else f'{base}-inference.safetensors'
+
+
+def save_flat_weights(tensors, path, metadata=None):
+    '''
+    Writes the dict of name -> tensor to path. metadata is an optional dict of
+    strings stored in the header. The file is written under a temporary name
+    and renamed into place, so a half-written file is never loaded.
+    '''
+    # largest elements first keeps every tensor aligned to its element size
+    names  = sorted(tensors, key=lambda n: -tensors[n].element_size())
+    header = {'__metadata__': metadata} if metadata else {}
+    offset = 0
+    for name in names:
+        t = tensors[name]
+        size = t.numel() * t.element_size()
+        header[name] = {
+            'dtype':        DTYPE_NAMES[t.dtype],
+            'shape':        list(t.shape),
+            'data_offsets': [offset, offset + size],
+        }
+        offset += size
+    header_bytes  = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            t = tensors[name].detach().cpu().contiguous()
+            t = t.view(_WRITE_AS.get(t.dtype, t.dtype))
+            f.write(t.numpy().reshape(-1).view(np.uint8).data)
+    os.replace(tmp_path, path)
+
+
+def load_flat_weights(path):
+    '''
+    Maps the file at path into memory and returns (tensors, metadata). The
+    tensors share memory with the mapping, which is copy-on-write so that
+    changing a tensor never changes the file.
+    '''
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = struct.unpack('<Q', mapped[:8])[0]
+    header      = json.loads(mapped[8:8 + header_size])
+    data_start  = 8 + header_size
+    metadata    = header.pop('__metadata__', None) or {}
+
+    tensors = {}
+    for name, info in header.items():
+        dtype      = DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        count      = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+        if count == 0:
+            t = torch.empty(0, dtype=dtype)
+        else:
+            t = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + begin)
+        tensors[name] = t.reshape(info['shape'])
+    return tensors, metadata
+
+
+def read_flat_weights_metadata(path):
+    '''Returns the metadata of the flat weights file at path, reading only its header'''
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header      = json.loads(f.read(header_size))
+    return header.get('__metadata__') or {}
+
+
+def convert_checkpoint(ckpt, path, half=False):
+    '''
+    Converts the state_dict of a .ckpt file to a flat weights file. Raises
+    OSError, before writing anything, if there isn't room for it.
+    '''
+    tic = time.time()
+    pl_sd = torch.load(ckpt, map_location='cpu')
+    sd    = pl_sd['state_dict']
+    tensors = {}
+    for name, t in sd.items():
+        if not isinstance(t, torch.Tensor):
+            continue
+        tensors[name] = t.half() if half and t.is_floating_point() else t
+
+    size = sum(t.numel() * t.element_size() for t in tensors.values())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+    if size > free:
+        raise OSError(f'{path} needs {size / 1e9:.1f}GB but only {free / 1e9:.1f}GB is free')
+    print(f'>> Writing a {size / 1e9:.1f}GB memory-mapped copy of {ckpt} to {path} (--mmap_weights).')
+    print('>> This is done only once; delete the file to reclaim the space.')
+    save_flat_weights(tensors, path, metadata={'source': os.path.basename(ckpt)})
+    print(f'>> Converted in {time.time() - tic:4.2f}s')
+
+
+@contextmanager
+def parameters_on_meta_device():
+    '''
+    While active, parameters registered on modules built by the calling
+    thread are moved to the meta device as soon as they are created, so
+    building a model doesn't allocate or initialize its weights.
+
+    torch 1.11 has no device context manager, so this patches
+    nn.Module.register_parameter. The patch only acts for the thread that
+    entered; modules that other threads build meanwhile, such as the GFPGAN
+    models loaded by the postprocessing workers, get real parameters. Only
+    one thread at a time can be inside, and others wait for it.
+    '''
+    with _meta_lock:
+        register_parameter = nn.Module.register_parameter
+
+        def register_on_meta(module, name, param):
+            register_parameter(module, name, param)
+            if param is not None and getattr(_meta_local, 'active', False):
+                module._parameters[name] = nn.Parameter(
+                    param.to('meta'), requires_grad=param.requires_grad
+                )
+
+        nn.Module.register_parameter = register_on_meta
+        _meta_local.active = True
+        try:
+            yield
+        finally:
+            _meta_local.active = False
+            nn.Module.register_parameter = register_parameter
+
+
+def assign_weights(model, tensors):
+    '''
+    Replaces the model's parameters and buffers with the tensors of the same
+    name, without copying. Names the model doesn't have are skipped, as
+    load_state_dict(strict=False) would.
+    '''
+    for name, t in tensors.items():
+        module_name, _, leaf = name.rpartition('.')
+        try:
+            module = model.get_submodule(module_name)
+        except AttributeError:
+            continue
+        if module._parameters.get(leaf) is not None:
+            old = module._parameters[leaf]
+            assert old.shape == t.shape, f'{name}: expected shape {tuple(old.shape)}, found {tuple(t.shape)}'
+            module._parameters[leaf] = nn.Parameter(t, requires_grad=old.requires_grad)
+        elif module._buffers.get(leaf) is not None:
+            module._buffers[leaf] = t
+
+
+def load_model_from_flat_weights(config, path):
+    '''
+    Builds the model described by the OmegaConf config with the weights in
+    path. Raises RuntimeError if the file lacks weights that the model needs.
+    '''
+    tensors, _ = load_flat_weights(path)
+    try:
+        with parameters_on_meta_device():
+            model = instantiate_from_config(config.model)
+    except Exception as e:
+        # some third-party module didn't like meta parameters
+        print(f'>> Could not build the model on the meta device ({e}); initializing its weights instead')
+        model = instantiate_from_config(config.model)
+    assign_weights(model, tensors)
+
+    # the embedding manager copies its initial embeddings from the text
+    # encoder's weights, which were on the meta device when it was built
+    personalization_config = config.model.params.get('personalization_config')
+    if personalization_config is not None and getattr(model, 'embedding_manager', None) is not None:
+        model.embedding_manager = model.instantiate_embedding_manager(
+            personalization_config, model.cond_stage_model
+        )
+        for param in model.embedding_manager.embedding_parameters():
+            param.requires_grad = True
+
+    missing = [
+        name for name, t in list(model.named_parameters()) + list(model.named_buffers())
+        if t.is_meta
+    ]
+    if missing:
+        raise RuntimeError(f'{path} has no weights for {", ".join(missing[:5])}' + (' ...' if len(missing) > 5 else ''))
+    return model
+
+
+def strip_training_config(config):
+    '''
+    Returns a copy of the OmegaConf config with what only training needs
+    taken out: EMA tracking, the learning rate schedule, the autoencoder's
+    loss and the checkpoint paths that models would otherwise load themselves.
+    '''
+    config = OmegaConf.create(OmegaConf.to_container(config, resolve=True))
+    params = config.model.params
+    params.use_ema = False
+    for key in ('scheduler_config', 'monitor', 'ckpt_path', 'ignore_keys'):
+        params.pop(key, None)
+    first_stage = params.get('first_stage_config')
+    if first_stage is not None and 'params' in first_stage:
+        first_stage.params.lossconfig = {'target': 'torch.nn.Identity'}
+        for key in ('monitor', 'ckpt_path', 'ignore_keys'):
+            first_stage.params.pop(key, None)
+    config.model.pop('base_learning_rate', None)
+    config.pop('lightning', None)
+    config.pop('data', None)
+    return config
+
+
+def swap_in_ema_weights(sd):
+    '''
+    Replaces the diffusion model weights in the state_dict sd with their EMA
+    copies, if it has them, in place. Returns how many were replaced.
+    '''
+    # LitEma names its copies after the parameters of model, dots removed
+    swapped = 0
+    for name in list(sd):
+        if not name.startswith('model.'):
+            continue
+        ema_name = 'model_ema.' + name[len('model.'):].replace('.', '')
+        if ema_name in sd:
+            sd[name] = sd[ema_name]
+            swapped += 1
+    return swapped
+
+
+def export_inference_snapshot(config, ckpt, path, half=True, use_ema=True):
+    '''
+    Writes the inference snapshot of the model that the OmegaConf config
+    describes, with the weights in ckpt, to path
+    '''
+    tic = time.time()
+    config = strip_training_config(config)
+    sd = torch.load(ckpt, map_location='cpu')['state_dict']
+    swapped = 0
+    if use_ema:
+        swapped = swap_in_ema_weights(sd)
+        print(f'>> Swapped in {swapped} EMA weights' if swapped else '>> No EMA weights found; using the model weights')
+
+    # keep only what the stripped model has
+    with parameters_on_meta_device():
+        model = instantiate_from_config(config.model)
+    wanted  = set(model.state_dict())
+    tensors = {}
+    for name, t in sd.items():
+        if name not in wanted or not isinstance(t, torch.Tensor):
+            continue
+        tensors[name] = t.half() if half and t.is_floating_point() else t
+    dropped = len(sd) - len(tensors)
+    print(f'>> Keeping {len(tensors)} tensors, dropping {dropped} that only training uses')
+
+    save_flat_weights(tensors, path, metadata={
+        'source': os.path.basename(ckpt),
+        'config': OmegaConf.to_yaml(config),
+        'dtype':  'F16' if half else 'F32',
+        'ema':    str(swapped > 0),
+    })
+    print(f'>> Wrote {path} in', '%4.2fs' % (time.time() - tic))
+
+
+def is_inference_snapshot(path):
+    try:
+        return path.endswith('.safetensors') and 'config' in read_flat_weights_metadata(path)
+    except (OSError, ValueError, struct.error):
+        return False
+
+
+def load_inference_snapshot(path):
+    '''Builds the model stored in the inference snapshot at path. Returns (model, config)'''
+    config = OmegaConf.create(read_flat_weights_metadata(path)['config'])
+    return load_model_from_flat_weights(config, path), config
@@ -0,0 +1,137 @@
+'''
+The web server's record of generated images, kept in a SQLite database in
+the output directory. It replaces dream_web_log.txt, which had to be read
+and parsed in full every time the page was loaded. An existing
+dream_web_log.txt is imported the first time the database is opened.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class GalleryStore:
+    def __init__(self, db_path, legacy_log=None):
+        self.db_path = db_path
+        self.lock    = threading.Lock()
+        self.db      = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS images (
+                     id      INTEGER PRIMARY KEY AUTOINCREMENT,
+                     url     TEXT NOT NULL,
+                     seed    INTEGER,
+                     prompt  TEXT,
+                     created REAL NOT NULL,
+                     config  TEXT NOT NULL
+                   )'''
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS images_seed ON images (seed)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS images_created ON images (created)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        if legacy_log is not None:
+            self._import_legacy_log(legacy_log)
+
+    def add(self, url, seed, config) -> int:
+        '''Records an image written to url, with the request config that made it. Returns its id'''
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                'INSERT INTO images (url, seed, prompt, created, config) VALUES (?, ?, ?, ?, ?)',
+                (url, seed, config.get('prompt'), time.time(), json.dumps(config)),
+            )
+            return cursor.lastrowid
+
+    def query(self, limit=100, before=None, since=None, prompt=None, seed=None,
+              start=None, end=None) -> dict:
+        '''
+        Without since, looks up the newest limit images with ids below before;
+        with since, the oldest limit images with ids above it. prompt matches
+        any part of the prompt, and start and end are unix times bounding when
+        the images were made. Returns a dict of
+          run_log  -- the request configs, oldest first, with 'url' and 'id' added.
+                      Images whose files are gone are left out.
+          more     -- True if the lookup stopped at limit
+          first_id -- the lowest and highest ids looked at, to pass as before
+          last_id     or since for the next page
+        '''
+        where, params = [], []
+        if before is not None:
+            where.append('id < ?')
+            params.append(before)
+        if since is not None:
+            where.append('id > ?')
+            params.append(since)
+        if prompt:
+            where.append("prompt LIKE ? ESCAPE '\\'")
+            escaped = prompt.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f'%{escaped}%')
+        if seed is not None:
+            where.append('seed = ?')
+            params.append(seed)
+        if start is not None:
+            where.append('created >= ?')
+            params.append(start)
+        if end is not None:
+            where.append('created < ?')
+            params.append(end)
+        sql = 'SELECT id, url, config FROM images'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id ' + ('ASC' if since is not None else 'DESC') + ' LIMIT ?'
+        params.append(limit + 1)
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if since is None:
+            rows.reverse()
+
+        entries = []
+        for row in rows:
+            if not os.path.exists(row['url']):
+                continue
+            config = json.loads(row['config'])
+            config['url'] = row['url'].lstrip('.')
+            config['id']  = row['id']
+            entries.append(config)
+        return {
+            'run_log':  entries,
+            'more':     more,
+            'first_id': rows[0]['id'] if rows else None,
+            'last_id':  rows[-1]['id'] if rows else None,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _import_legacy_log(self, log_file):
+        with self.lock:
+            done = self.db.execute("SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone()
+        if done or not os.path.exists(log_file):
+            return
+        print(f'>> Importing {log_file} into {self.db_path}')
+        records = []
+        with open(log_file, 'r') as log:
+            for line in log:
+                try:
+                    url, config = line.split(': {', maxsplit=1)
+                    config = json.loads('{' + config)
+                except ValueError:
+                    continue
+                created = os.path.getmtime(url) if os.path.exists(url) else 0
+                try:
+                    seed = int(config.get('seed'))
+                except (TypeError, ValueError):
+                    seed = None
+                records.append((url, seed, config.get('prompt'), created, json.dumps(config)))
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO images (url, seed, prompt, created, config) VALUES (?, ?, ?, ?, ?)',
+                records,
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', '1')")
+        print(f'>> Imported {len(records)} images')
@@ -5,11 +5,10 @@ including img2img, txt2img, and inpaint
 import torch
 import numpy as  np
 import random
-from tqdm import tqdm, trange
+from tqdm import tqdm
 from PIL               import Image
 from einops import rearrange, repeat
-from pytorch_lightning import seed_everything
-from ldm.dream.devices import choose_autocast_device
+from ldm.dream.devices import choose_autocast_device, choose_batch_size
 
 downsampling = 8
 
@@ -21,6 +20,7 @@ class Generator():
         self.downsampling_factor = downsampling   # BUG: should come from model or config
         self.variation_amount    = 0
         self.with_variations     = []
+        self.tiled_vae           = None    # a TiledVAE to encode and decode large images with
 
     # this is going to be overridden in img2img.py, txt2img.py and inpaint.py
     def get_make_image(self,prompt,**kwargs):
@@ -36,7 +36,7 @@ class Generator():
         self.with_variations  = with_variations
 
     def generate(self,prompt,init_image,width,height,iterations=1,seed=None,
-                 image_callback=None, step_callback=None,
+                 image_callback=None, step_callback=None, batch_size=1,
                  **kwargs):
         device_type,scope   = choose_autocast_device(self.model.device)
         make_image          = self.get_make_image(
@@ -51,67 +51,142 @@ class Generator():
         results             = []
         seed                = seed if seed else self.new_seed()
         seed, initial_noise = self.generate_initial_noise(seed, width, height)
+        if not batch_size or batch_size < 1:
+            batch_size      = choose_batch_size(self.model.device, width, height,
+                                                full_precision = self.model.dtype == torch.float32)
+            print(f'>> Sampling up to {batch_size} images per batch')
+        batch_size          = min(batch_size, iterations)
         with scope(device_type), self.model.ema_scope():
-            for n in trange(iterations, desc='Generating'):
-                x_T = None
-                if self.variation_amount > 0:
-                    seed_everything(seed)
-                    target_noise = self.get_noise(width,height)
-                    x_T = self.slerp(self.variation_amount, initial_noise, target_noise)
-                elif initial_noise is not None:
-                    # i.e. we specified particular variations
-                    x_T = initial_noise
-                else:
-                    seed_everything(seed)
-                    if self.model.device.type == 'mps':
-                        x_T = self.get_noise(width,height)
-
-                # make_image will do the equivalent of get_noise itself
-                image = make_image(x_T)
-                results.append([image, seed])
-                if image_callback is not None:
-                    image_callback(image, seed)
-                seed = self.new_seed()
+            progress = tqdm(total=iterations, desc='Generating')
+            while len(results) < iterations:
+                # stack one noise tensor per seed so that each image in the
+                # batch starts from the same latent it would get on its own
+                seeds = []
+                for n in range(min(batch_size, iterations - len(results))):
+                    seeds.append(seed)
+                    seed = self.next_seed(seed)
+
+                # each row's generator goes on to give the noise the sampler
+                # adds to that row, so an image is the same batched or not;
+                # the global RNGs are never used
+                generators = [self.noise_generator(s) for s in seeds]
+                noise      = self.get_noise_for_seeds(seeds, width, height, initial_noise, generators)
+                images     = make_image(noise, generator=generators)
+                for image, image_seed in zip(images, seeds):
+                    results.append([image, image_seed])
+                    if image_callback is not None:
+                        image_callback(image, image_seed)
+                progress.update(len(seeds))
+            progress.close()
         return results
-    
+
+    def get_noise_for_seed(self, seed, width, height, initial_noise=None):
+        """
+        Returns the starting latent noise for the given seed, taking the
+        requested variations into account
+        """
+        return self.get_noise_for_seeds([seed], width, height, initial_noise)
+
+    def get_noise_for_seeds(self, seeds, width, height, initial_noise=None, generators=None):
+        """
+        Returns the starting latent noise for each of the seeds, stacked into
+        one batch, taking the requested variations into account. Each seed's
+        noise comes from a generator of its own, so the global RNGs are left
+        alone, and the variations are slerped in one go on the device.
+        generators, if given, are the noise_generator()s of the seeds, which
+        are left where the noise drawn from them ends.
+        """
+        if initial_noise is not None and self.variation_amount == 0:
+            # i.e. we specified particular variations
+            return torch.cat([initial_noise] * len(seeds))
+        if generators is None:
+            generators = [self.noise_generator(seed) for seed in seeds]
+        noise = torch.cat([
+            self.get_noise(width, height, generator=generator)
+            for generator in generators
+        ])
+        if self.variation_amount > 0:
+            noise = self.slerp(self.variation_amount, initial_noise, noise)
+        return noise
+
+    def noise_generator(self, seed):
+        """
+        Returns a torch.Generator seeded with seed, on the device that noise is
+        drawn on. mps doesn't have generators, so its noise is drawn on the CPU.
+        """
+        device = self.model.device
+        if device.type == 'mps':
+            device = torch.device('cpu')
+        return torch.Generator(device=device).manual_seed(seed)
+
+    def repeat_conditioning(self, conditioning, batch_size):
+        """
+        Expands the (uc, c) conditioning pair to batch_size rows
+        """
+        return tuple(
+            cond if cond.shape[0] == batch_size else torch.cat([cond] * batch_size)
+            for cond in conditioning
+        )
+
     def sample_to_image(self,samples):
         """
         Returns a function returning an image derived from the prompt and the initial image
         Return value depends on the seed at the time you call it
         """
-        x_samples = self.model.decode_first_stage(samples)
-        x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-        if len(x_samples) != 1:
+        images = self.sample_to_images(samples)
+        if len(images) != 1:
             raise Exception(
-                f'>> expected to get a single image, but got {len(x_samples)}')
-        x_sample = 255.0 * rearrange(
-            x_samples[0].cpu().numpy(), 'c h w -> h w c'
-        )
-        return Image.fromarray(x_sample.astype(np.uint8))
+                f'>> expected to get a single image, but got {len(images)}')
+        return images[0]
+
+    def sample_to_images(self,samples):
+        """
+        Decodes a batch of latents and returns a list of Images, one per row
+        """
+        x_samples = self.decode_latents(samples)
+        x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+        images    = []
+        for x_sample in x_samples:
+            x_sample = 255.0 * rearrange(
+                x_sample.cpu().numpy(), 'c h w -> h w c'
+            )
+            images.append(Image.fromarray(x_sample.astype(np.uint8)))
+        return images
+
+    def decode_latents(self, samples):
+        if self.tiled_vae is not None:
+            return self.tiled_vae.decode(samples)
+        return self.model.decode_first_stage(samples)
+
+    def encode_image(self, image):
+        '''Moves image into latent space'''
+        if self.tiled_vae is not None:
+            posterior = self.tiled_vae.encode(image)
+        else:
+            posterior = self.model.encode_first_stage(image)
+        return self.model.get_first_stage_encoding(posterior)
 
     def generate_initial_noise(self, seed, width, height):
         initial_noise = None
         if self.variation_amount > 0 or len(self.with_variations) > 0:
             # use fixed initial noise plus random noise per iteration
-            seed_everything(seed)
-            initial_noise = self.get_noise(width,height)
+            initial_noise = self.get_noise(width,height,generator=self.noise_generator(seed))
             for v_seed, v_weight in self.with_variations:
                 seed = v_seed
-                seed_everything(seed)
-                next_noise = self.get_noise(width,height)
+                next_noise = self.get_noise(width,height,generator=self.noise_generator(seed))
                 initial_noise = self.slerp(v_weight, initial_noise, next_noise)
             if self.variation_amount > 0:
-                random.seed() # reset RNG to an actually random state, so we can get a random seed for variations
-                seed = random.randrange(0,np.iinfo(np.uint32).max)
+                seed = self.new_seed() # a random seed for the variations
             return (seed, initial_noise)
         else:
             return (seed, None)
 
     # returns a tensor filled with random numbers from a normal distribution
-    def get_noise(self,width,height):
+    def get_noise(self,width,height,generator=None):
         """
         Returns a tensor filled with random numbers, either form a normal distribution
-        (txt2img) or from the latent image (img2img, inpaint)
+        (txt2img) or from the latent image (img2img, inpaint), drawn from generator
+        if one is given and from the global RNG if not
         """
         raise NotImplementedError("get_noise() must be implemented in a descendent class")
     
@@ -119,40 +194,45 @@ class Generator():
         self.seed = random.randrange(0, np.iinfo(np.uint32).max)
         return self.seed
 
+    def next_seed(self, seed):
+        '''
+        The seed that follows seed in a run of images. It is derived from seed
+        alone, so -S with -n always gives the same run of seeds, and these are
+        the ones that reseeding the global RNG with each seed used to give.
+        '''
+        self.seed = random.Random(seed).randrange(0, np.iinfo(np.uint32).max)
+        return self.seed
+
     def slerp(self, t, v0, v1, DOT_THRESHOLD=0.9995):
         '''
-        Spherical linear interpolation
+        Spherical linear interpolation, row by row, on the tensors' device
         Args:
-            t (float/np.ndarray): Float value between 0.0 and 1.0
-            v0 (np.ndarray): Starting vector
-            v1 (np.ndarray): Final vector
+            t (float/torch.Tensor): Float value between 0.0 and 1.0, or one per row
+            v0 (torch.Tensor): Starting vectors, one per row of the batch, or a
+                               single row to start every row from
+            v1 (torch.Tensor): Final vectors, one per row
             DOT_THRESHOLD (float): Threshold for considering the two vectors as
                                 colineal. Not recommended to alter this.
         Returns:
-            v2 (np.ndarray): Interpolation vector between v0 and v1
+            v2 (torch.Tensor): Interpolation vectors between v0 and v1
         '''
-        inputs_are_torch = False
-        if not isinstance(v0, np.ndarray):
-            inputs_are_torch = True
-            v0 = v0.detach().cpu().numpy()
-        if not isinstance(v1, np.ndarray):
-            inputs_are_torch = True
-            v1 = v1.detach().cpu().numpy()
-
-        dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
-        if np.abs(dot) > DOT_THRESHOLD:
-            v2 = (1 - t) * v0 + t * v1
-        else:
-            theta_0 = np.arccos(dot)
-            sin_theta_0 = np.sin(theta_0)
-            theta_t = theta_0 * t
-            sin_theta_t = np.sin(theta_t)
-            s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-            s1 = sin_theta_t / sin_theta_0
-            v2 = s0 * v0 + s1 * v1
-
-        if inputs_are_torch:
-            v2 = torch.from_numpy(v2).to(self.model.device)
-
-        return v2
+        dtype  = v1.dtype
+        v0, v1 = v0.float(), v1.float()
+        shape  = (-1,) + (1,) * (v1.ndim - 1)
+        t      = torch.as_tensor(t, dtype=torch.float32, device=v1.device).reshape(shape)
 
+        dot = (v0 * v1).flatten(1).sum(1) / (
+            v0.flatten(1).norm(dim=1) * v1.flatten(1).norm(dim=1)
+        )
+        dot = dot.reshape(shape)
+        theta_0     = torch.acos(dot.clamp(-1.0, 1.0))
+        sin_theta_0 = torch.sin(theta_0)
+        theta_t     = theta_0 * t
+        s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = torch.sin(theta_t) / sin_theta_0
+        v2 = torch.where(
+            dot.abs() > DOT_THRESHOLD,
+            (1 - t) * v0 + t * v1,    # nearly colinear: lerp is close enough
+            s0 * v0 + s1 * v1,
+        )
+        return v2.to(dtype)
@@ -7,6 +7,7 @@ import numpy as  np
 from ldm.dream.devices             import choose_autocast_device
 from ldm.dream.generator.base      import Generator
 from ldm.models.diffusion.ddim     import DDIMSampler
+from ldm.models.diffusion.plms     import PLMSSampler
 
 class Img2Img(Generator):
     def __init__(self,model):
@@ -15,14 +16,15 @@ class Img2Img(Generator):
     
     @torch.no_grad()
     def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
-                       conditioning,init_image,strength,step_callback=None,**kwargs):
+                       conditioning,init_image,strength,step_callback=None,
+                       cfg_truncation=0.0,**kwargs):
         """
-        Returns a function returning an image derived from the prompt and the initial image
-        Return value depends on the seed at the time you call it.
+        Returns a function returning a list of images derived from the prompt and the
+        initial image, one for each row of the initial noise tensor passed to it.
         """
 
-        # PLMS sampler not supported yet, so ignore previous sampler
-        if not isinstance(sampler,DDIMSampler):
+        # PLMS sampler not supported yet, so use DDIM in its place
+        if isinstance(sampler,PLMSSampler):
             print(
                 f">> sampler '{sampler.__class__.__name__}' is not yet supported. Using DDIM sampler"
             )
@@ -34,19 +36,19 @@ class Img2Img(Generator):
 
         device_type,scope   = choose_autocast_device(self.model.device)
         with scope(device_type):
-            self.init_latent = self.model.get_first_stage_encoding(
-                self.model.encode_first_stage(init_image)
-            ) # move to latent space
+            self.init_latent = self.encode_image(init_image) # move to latent space
 
         t_enc = int(strength * steps)
-        uc, c   = conditioning
 
         @torch.no_grad()
-        def make_image(x_T):
+        def make_image(x_T, generator=None):
+            batch_size  = x_T.shape[0]
+            uc, c       = self.repeat_conditioning(conditioning, batch_size)
+            init_latent = torch.cat([self.init_latent] * batch_size)
             # encode (scaled latent)
             z_enc = sampler.stochastic_encode(
-                self.init_latent,
-                torch.tensor([t_enc]).to(self.model.device),
+                init_latent,
+                torch.tensor([t_enc] * batch_size).to(self.model.device),
                 noise=x_T
             )
             # decode it
@@ -57,16 +59,20 @@ class Img2Img(Generator):
                 img_callback = step_callback,
                 unconditional_guidance_scale=cfg_scale,
                 unconditional_conditioning=uc,
+                cfg_truncation=cfg_truncation,
+                generator=generator,
             )
-            return self.sample_to_image(samples)
+            return self.sample_to_images(samples)
 
         return make_image
 
-    def get_noise(self,width,height):
+    def get_noise(self,width,height,generator=None):
         device      = self.model.device
         init_latent = self.init_latent
         assert init_latent is not None,'call to get_noise() when init_latent not set'
-        if device.type == 'mps':
-            return torch.randn_like(init_latent, device='cpu').to(device)
-        else:
-            return torch.randn_like(init_latent, device=device)
+        # mps noise is drawn on the CPU; so is any noise from a CPU generator
+        draw_on     = generator.device if generator is not None else device
+        if draw_on.type == 'mps':
+            draw_on = torch.device('cpu')
+        return torch.randn(init_latent.shape, generator=generator,
+                           dtype=init_latent.dtype, device=draw_on).to(device)
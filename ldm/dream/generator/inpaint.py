@@ -8,6 +8,7 @@ from einops import rearrange, repeat
 from ldm.dream.devices             import choose_autocast_device
 from ldm.dream.generator.img2img   import Img2Img
 from ldm.models.diffusion.ddim     import DDIMSampler
+from ldm.models.diffusion.plms     import PLMSSampler
 
 class Inpaint(Img2Img):
     def __init__(self,model):
@@ -17,44 +18,44 @@ class Inpaint(Img2Img):
     @torch.no_grad()
     def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
                        conditioning,init_image,mask_image,strength,
-                       step_callback=None,**kwargs):
+                       step_callback=None,cfg_truncation=0.0,**kwargs):
         """
-        Returns a function returning an image derived from the prompt and
-        the initial image + mask.  Return value depends on the seed at
-        the time you call it.  kwargs are 'init_latent' and 'strength'
+        Returns a function returning a list of images derived from the prompt,
+        the initial image and the mask, one for each row of the initial noise
+        tensor passed to it.
         """
 
         mask_image = mask_image[0][0].unsqueeze(0).repeat(4,1,1).unsqueeze(0)
-        mask_image = repeat(mask_image, '1 ... -> b ...', b=1)
 
-        # PLMS sampler not supported yet, so ignore previous sampler
-        if not isinstance(sampler,DDIMSampler):
+        # PLMS sampler not supported yet, so use DDIM in its place
+        if isinstance(sampler,PLMSSampler):
             print(
                 f">> sampler '{sampler.__class__.__name__}' is not yet supported. Using DDIM sampler"
             )
             sampler = DDIMSampler(self.model, device=self.model.device)
 
-            sampler.make_schedule(
-                ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False
-            )
+        sampler.make_schedule(
+            ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False
+        )
 
         device_type,scope   = choose_autocast_device(self.model.device)
         with scope(device_type):
-            self.init_latent = self.model.get_first_stage_encoding(
-                self.model.encode_first_stage(init_image)
-            ) # move to latent space
+            self.init_latent = self.encode_image(init_image) # move to latent space
 
         t_enc   = int(strength * steps)
-        uc, c   = conditioning
 
         print(f">> target t_enc is {t_enc} steps")
 
         @torch.no_grad()
-        def make_image(x_T):
+        def make_image(x_T, generator=None):
+            batch_size  = x_T.shape[0]
+            uc, c       = self.repeat_conditioning(conditioning, batch_size)
+            init_latent = torch.cat([self.init_latent] * batch_size)
+            mask        = repeat(mask_image, '1 ... -> b ...', b=batch_size)
             # encode (scaled latent)
             z_enc = sampler.stochastic_encode(
-                self.init_latent,
-                torch.tensor([t_enc]).to(self.model.device),
+                init_latent,
+                torch.tensor([t_enc] * batch_size).to(self.model.device),
                 noise=x_T
             )
                                        
@@ -66,10 +67,12 @@ class Inpaint(Img2Img):
                 img_callback                 = step_callback,
                 unconditional_guidance_scale = cfg_scale,
                 unconditional_conditioning = uc,
-                mask                       = mask_image,
-                init_latent                = self.init_latent
+                mask                       = mask,
+                init_latent                = init_latent,
+                cfg_truncation             = cfg_truncation,
+                generator                  = generator,
             )
-            return self.sample_to_image(samples)
+            return self.sample_to_images(samples)
 
         return make_image
 
@@ -12,23 +12,26 @@ class Txt2Img(Generator):
     
     @torch.no_grad()
     def get_make_image(self,prompt,sampler,steps,cfg_scale,ddim_eta,
-                       conditioning,width,height,step_callback=None,**kwargs):
+                       conditioning,width,height,step_callback=None,
+                       cfg_truncation=0.0,**kwargs):
         """
-        Returns a function returning an image derived from the prompt and the initial image
-        Return value depends on the seed at the time you call it
+        Returns a function returning a list of images derived from the prompt,
+        one for each row of the initial noise tensor passed to it. Any further
+        noise the sampler needs comes from the torch.Generator passed with it,
+        or from a list of them, one per row.
         kwargs are 'width' and 'height'
         """
-        uc, c   = conditioning
-
         @torch.no_grad()
-        def make_image(x_T):
+        def make_image(x_T, generator=None):
+            batch_size = x_T.shape[0]
+            uc, c      = self.repeat_conditioning(conditioning, batch_size)
             shape = [
                 self.latent_channels,
                 height // self.downsampling_factor,
                 width  // self.downsampling_factor,
             ]
             samples, _ = sampler.sample(
-                batch_size                   = 1,
+                batch_size                   = batch_size,
                 S                            = steps,
                 x_T                          = x_T,
                 conditioning                 = c,
@@ -37,25 +40,25 @@ class Txt2Img(Generator):
                 unconditional_guidance_scale = cfg_scale,
                 unconditional_conditioning   = uc,
                 eta                          = ddim_eta,
-                img_callback                 = step_callback
+                img_callback                 = step_callback,
+                cfg_truncation               = cfg_truncation,
+                generator                    = generator,
             )
-            return self.sample_to_image(samples)
+            return self.sample_to_images(samples)
 
         return make_image
 
 
     # returns a tensor filled with random numbers from a normal distribution
-    def get_noise(self,width,height):
+    def get_noise(self,width,height,generator=None):
         device         = self.model.device
-        if device.type == 'mps':
-            return torch.randn([1,
-                                self.latent_channels,
-                                height // self.downsampling_factor,
-                                width  // self.downsampling_factor],
-                               device='cpu').to(device)
-        else:
-            return torch.randn([1,
-                                self.latent_channels,
-                                height // self.downsampling_factor,
-                                width  // self.downsampling_factor],
-                               device=device)
+        # mps noise is drawn on the CPU; so is any noise from a CPU generator
+        draw_on        = generator.device if generator is not None else device
+        if draw_on.type == 'mps':
+            draw_on    = torch.device('cpu')
+        return torch.randn([1,
+                            self.latent_channels,
+                            height // self.downsampling_factor,
+                            width  // self.downsampling_factor],
+                           generator=generator,
+                           device=draw_on).to(device)
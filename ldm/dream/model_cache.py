@@ -0,0 +1,88 @@
+'''
+Keeps several of the models described in configs/models.yaml loaded at once,
+so that switching between them doesn't mean reading the checkpoint again.
+
+Only the active model lives on the device. With park_on_cpu, the others are
+moved to CPU memory; otherwise they stay where they are. Either way, when the
+models held add up to more than max_gb, the least recently used ones are
+dropped.
+'''
+import gc
+import torch
+from collections import OrderedDict
+
+class ModelCache:
+    def __init__(self, max_gb=12.0, park_on_cpu=True):
+        self.max_bytes   = int(max_gb * 2**30)
+        self.park_on_cpu = park_on_cpu
+        self.models      = OrderedDict()   # name -> model, least recently used first
+        self.active      = None
+
+    def get(self, name, loader, device):
+        '''
+        Returns the model called name on device, making it the active model.
+        loader() is called to load it if it isn't in the cache.
+        '''
+        if name == self.active:
+            self.models.move_to_end(name)
+            return self.models[name]
+        self._park_active()
+        self.active = None
+        if name in self.models:
+            print(f'>> Retrieving model {name} from the model cache')
+            model = self.models.pop(name)
+            self._move(model, device)
+        else:
+            model = loader()
+        self.models[name] = model
+        self.active       = name
+        self._evict()
+        return model
+
+    def drop(self, name):
+        '''Forgets the model called name'''
+        self.models.pop(name, None)
+        if name == self.active:
+            self.active = None
+        self._free()
+
+    def size_of(self, model) -> int:
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def stats(self) -> dict:
+        return {
+            'models': list(self.models),
+            'active': self.active,
+            'bytes':  sum(self.size_of(m) for m in self.models.values()),
+        }
+
+    def _park_active(self):
+        if self.active is None or not self.park_on_cpu:
+            return
+        model = self.models.get(self.active)
+        if model is not None:
+            print(f'>> Parking model {self.active} in CPU memory')
+            self._move(model, torch.device('cpu'))
+            self._free()
+
+    def _evict(self):
+        total = sum(self.size_of(m) for m in self.models.values())
+        for name in list(self.models):
+            if total <= self.max_bytes:
+                break
+            if name == self.active:
+                continue
+            print(f'>> Dropping model {name} from the model cache to stay under the memory budget')
+            total -= self.size_of(self.models.pop(name))
+        self._free()
+
+    def _move(self, model, device):
+        model.to(device)
+        # model.to doesn't change the cond_stage_model.device used to move the tokenizer output
+        model.cond_stage_model.device = device
+
+    def _free(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -1,43 +1,223 @@
 """
-Two helper classes for dealing with PNG images and their path names.
+Helper classes for dealing with PNG images and their path names.
 PngWriter -- Converts Images generated by T2I into PNGs, finds
              appropriate names for them, and writes prompt metadata
              into the PNG.
+ImageWriterPool -- Background threads that do the encoding and writing
+             for PngWriter, so that generation doesn't wait on zlib.
 PromptFormatter -- Utility for converting a Namespace of prompt parameters
              back into a formatted prompt string with command-line switches.
 """
+import atexit
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import PngImagePlugin
 
-# -------------------image generation utils-----
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+# -------------------background writing-----
+
+
+class ImageWriterPool:
+    """
+    Encodes and writes images on a small pool of threads. At most max_pending
+    images may be waiting to be written; past that, submit() blocks until the
+    writers catch up, so a slow disk can't pile up images in memory. Writes
+    to the same path happen in the order they were submitted.
+    """
+    def __init__(self, workers=2, max_pending=8, compress_level=6):
+        self.workers        = workers
+        self.compress_level = compress_level
+        self.executor       = None
+        self.slots          = threading.BoundedSemaphore(max_pending)
+        self.lock           = threading.Lock()
+        self.pending        = dict()   # future -> path
+        self.last_for_path  = dict()   # path -> most recent future
+        self.errors         = []
+
+    def configure(self, workers=None, compress_level=None):
+        self.flush()
+        if compress_level is not None:
+            assert 0 <= compress_level <= 9, '--png_compression must be between 0 and 9'
+            self.compress_level = compress_level
+        if workers is not None and workers != self.workers:
+            self.shutdown()
+            self.workers = workers
+
+    def submit(self, image, path, prompt=None, format='png', quality=90):
+        """
+        Queues image to be written to path and returns a Future whose result
+        is path. prompt is stored as 'Dream' metadata in PNG files.
+        """
+        self.slots.acquire()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='ImageWriter'
+                )
+            previous = self.last_for_path.get(path)
+            future   = self.executor.submit(
+                self._write, previous, image, path, prompt, format, quality
+            )
+            self.pending[future]     = path
+            self.last_for_path[path] = future
+        future.add_done_callback(self._done)
+        return future
+
+    def flush(self):
+        """Waits for everything queued so far, then raises the first error seen since the last flush"""
+        with self.lock:
+            futures = list(self.pending)
+        for future in futures:
+            future.exception()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _write(self, previous, image, path, prompt, format, quality):
+        if previous is not None:
+            previous.exception()    # an earlier write to the same file goes first
+        if format == 'png':
+            info = PngImagePlugin.PngInfo()
+            if prompt is not None:
+                info.add_text('Dream', prompt)
+            image.save(path, 'PNG', pnginfo=info, compress_level=self.compress_level)
+        elif format == 'webp':
+            image.save(path, 'WEBP', quality=quality)
+        elif format in ('jpg', 'jpeg'):
+            image.convert('RGB').save(path, 'JPEG', quality=quality)
+        else:
+            raise ValueError(f'unsupported image format "{format}"')
+        return path
+
+    def _done(self, future):
+        with self.lock:
+            path = self.pending.pop(future, None)
+            if self.last_for_path.get(path) is future:
+                del self.last_for_path[path]
+            if future.exception() is not None:
+                print(f'** could not write {path}: {future.exception()}')
+                self.errors.append(future.exception())
+        self.slots.release()
+
+
+writer_pool = ImageWriterPool()
+
+
+@atexit.register
+def _flush_writer_pool():
+    try:
+        writer_pool.flush()
+    except Exception:
+        pass    # already reported as it happened
+    writer_pool.shutdown()
+
+# -------------------unique file names-----
+
+COUNTER_FILE  = '.next_prefix'
+_counter_lock = threading.Lock()   # flock() doesn't exclude threads of one process
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 class PngWriter:
-    def __init__(self, outdir):
-        self.outdir = outdir
+    """
+    Writes images into outdir. With shard_size set, each file goes in a
+    subdirectory of outdir named for its prefix // shard_size, so that no
+    single directory grows past shard_size prefixes.
+    """
+    def __init__(self, outdir, shard_size=None):
+        self.outdir     = outdir
+        self.shard_size = shard_size
         os.makedirs(outdir, exist_ok=True)
 
-    # gives the next unique prefix in outdir
+    # gives the next unique prefix in outdir. The next free number is kept in
+    # a small file in outdir, so this doesn't list the directory except the
+    # first time, and the file is locked so that concurrent writers, in this
+    # or another process, never get the same prefix.
     def unique_prefix(self):
-        # sort reverse alphabetically until we find max+1
-        dirlist = sorted(os.listdir(self.outdir), reverse=True)
-        # find the first filename that matches our pattern or return 000000.0.png
-        existing_name = next(
-            (f for f in dirlist if re.match('^(\d+)\..*\.png', f)),
-            '0000000.0.png',
-        )
-        basecount = int(existing_name.split('.', 1)[0]) + 1
+        counter_path = os.path.join(self.outdir, COUNTER_FILE)
+        with _counter_lock:
+            fd = os.open(counter_path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+') as f:
+                _lock_file(f)
+                try:
+                    f.seek(0)
+                    text = f.read().strip()
+                    basecount = int(text) if text.isdigit() else self._scan_for_last_prefix() + 1
+                    f.seek(0)
+                    f.truncate()
+                    f.write(f'{basecount + 1}\n')
+                    f.flush()
+                finally:
+                    _unlock_file(f)
         return f'{basecount:06}'
 
+    # finds the highest prefix already used in outdir and its shard directories
+    def _scan_for_last_prefix(self):
+        last = 0
+        for entry in os.scandir(self.outdir):
+            if entry.is_dir() and entry.name.isdigit():
+                for f in os.scandir(entry.path):
+                    last = max(last, self._prefix_of(f.name))
+            else:
+                last = max(last, self._prefix_of(entry.name))
+        return last
+
+    @staticmethod
+    def _prefix_of(filename):
+        match = re.match('^(\d+)\..*\.png', filename)
+        return int(match.group(1)) if match else 0
+
+    # full path that the file called name is written to
+    def path_for(self, name):
+        if not self.shard_size:
+            return os.path.join(self.outdir, name)
+        prefix = name.split('.', 1)[0]
+        assert prefix.isdigit(), f'sharded file names must start with a numeric prefix: {name}'
+        subdir = os.path.join(self.outdir, f'{int(prefix) // self.shard_size:04}')
+        os.makedirs(subdir, exist_ok=True)
+        return os.path.join(subdir, name)
+
     # saves image named _image_ to outdir/name, writing metadata from prompt
     # returns full path of output
     def save_image_and_prompt_to_png(self, image, prompt, name):
-        path = os.path.join(self.outdir, name)
-        info = PngImagePlugin.PngInfo()
-        info.add_text('Dream', prompt)
-        image.save(path, 'PNG', pnginfo=info)
-        return path
+        future = self.queue_image_and_prompt(image, prompt, name)
+        return future.result()
+
+    # like save_image_and_prompt_to_png(), but returns as soon as the image is
+    # queued with the writer pool. The returned future's result is the full path.
+    # format may be 'png', 'webp' or 'jpeg'; only png files carry the prompt.
+    def queue_image_and_prompt(self, image, prompt, name, format='png'):
+        path = self.path_for(name)
+        return writer_pool.submit(image, path, prompt, format=format)
 
 
 class PromptFormatter:
@@ -59,6 +239,11 @@ class PromptFormatter:
         switches.append(f'-H{opt.height       or t2i.height}')
         switches.append(f'-C{opt.cfg_scale    or t2i.cfg_scale}')
         switches.append(f'-A{opt.sampler_name or t2i.sampler_name}')
+        cfg_truncation = getattr(opt, 'cfg_truncation', None)
+        if cfg_truncation is None:
+            cfg_truncation = t2i.cfg_truncation
+        if cfg_truncation:
+            switches.append(f'--cfg_truncation {cfg_truncation}')
 # to do: put model name into the t2i object
 #        switches.append(f'--model{t2i.model_name}')
         if opt.seamless or t2i.seamless:
@@ -0,0 +1,69 @@
+'''
+Runs the upscaling and face restoration of finished images on background
+threads, so that they overlap with the sampling of the images that follow
+instead of waiting until every image is done.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class PostprocessPipeline:
+    def __init__(self, process, image_callback=None, workers=1, max_pending=None):
+        '''
+        process(image, seed) returns the postprocessed image. It is run by up to
+        workers threads, with at most max_pending images (2 per worker) waiting
+        or in progress; submit() blocks beyond that. With more than one
+        worker, process must be safe to call from several threads at once;
+        the GFPGAN and Real-ESRGAN functions are, since each model is locked
+        while it enhances an image.
+
+        image_callback(image, seed, upscaled=True) receives the results in the
+        order the images were submitted, on the thread that calls submit() and
+        finish(), never on a worker thread.
+        '''
+        assert workers >= 1, '--postprocess_workers must be at least 1'
+        self.process        = process
+        self.image_callback = image_callback
+        self.max_pending    = max_pending or 2 * workers
+        self.executor       = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='postprocess')
+        self.pending        = deque()    # (future, image, seed), in the order submitted
+        self.results        = []
+
+    def submit(self, image, seed):
+        '''Queues image for postprocessing, first delivering any results that are ready'''
+        self.deliver_ready()
+        while len(self.pending) >= self.max_pending:
+            self._deliver_next()
+        self.pending.append((self.executor.submit(self.process, image, seed), image, seed))
+
+    def deliver_ready(self):
+        '''Delivers the results that are done, as far as the first that isn't'''
+        while self.pending and self.pending[0][0].done():
+            self._deliver_next()
+
+    def finish(self) -> list:
+        '''Waits for and delivers the remaining results. Returns all the postprocessed images, in order'''
+        try:
+            while self.pending:
+                self._deliver_next()
+        finally:
+            self.executor.shutdown(wait=True)
+        return self.results
+
+    def cancel(self):
+        '''Drops the images not yet started and waits for the rest, without delivering them'''
+        for future, _, _ in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+    def _deliver_next(self):
+        future, image, seed = self.pending.popleft()
+        try:
+            image = future.result()
+        except Exception as e:
+            print(
+                f'>> Error running RealESRGAN or GFPGAN. Your image was not upscaled.\n{e}'
+            )
+        self.results.append(image)
+        if self.image_callback is not None:
+            self.image_callback(image, seed, upscaled=True)
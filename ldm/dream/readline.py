@@ -94,8 +94,10 @@ if readline_available:
                 '--steps','-s',
                 '--seed','-S',
                 '--iterations','-n',
+                '--batch_size','-b',
                 '--width','-W','--height','-H',
                 '--cfg_scale','-C',
+                '--cfg_truncation',
                 '--grid','-g',
                 '--individual','-i',
                 '--init_img','-I',
@@ -112,6 +114,7 @@ if readline_available:
                 '-save_orig','--save_original',
                 '--skip_normalize','-x',
                 '--log_tokenization','t',
+                '!switch','!models',
             ]
         ).complete
     )
@@ -0,0 +1,281 @@
+'''
+Request scheduler for the dream web server.
+
+Every web request becomes a GenerationJob that is queued with the
+RequestScheduler. A single scheduler thread owns the model: it takes the
+oldest pending job, gathers the other pending txt2img jobs that can share
+a sampler batch with it (same model, size, steps, sampler, cfg scale and
+tiling mode) and runs them together through Generate.prompts2images().
+Jobs that cannot be batched (img2img, inpainting, variations) run on their
+own through Generate.prompt2image(). A job may name a model from
+models.yaml, which the scheduler switches to before running it.
+
+Every job has an id, announced to the client in a 'job' event, that can be
+used to cancel it. A queued job that is canceled is dropped from the
+queue. A running job is checked at every sampler step: its events stop at
+once, and when every job in the batch has been canceled the batch is
+abandoned so the next one can start.
+
+Progress and results are not written to the client connections from the
+scheduler thread. Each job has its own event queue that the connection's
+handler thread drains, so a slow or broken connection never stalls the
+model.
+'''
+import collections
+import queue
+import threading
+import time
+import uuid
+import traceback
+import sys
+
+class CanceledException(Exception):
+    pass
+
+class GenerationJob:
+    '''
+    A request waiting for, or being served by, the scheduler. opt holds the
+    prompt2image() arguments. image_callback and step_callback are called on
+    the scheduler thread and report back to the client by calling emit().
+    '''
+    def __init__(self, opt, image_callback=None, step_callback=None):
+        self.id             = uuid.uuid4().hex[:12]
+        self.opt            = opt
+        self.image_callback = image_callback
+        self.step_callback  = step_callback
+        self.events         = queue.Queue()
+        self.canceled       = threading.Event()
+        self.state          = 'queued'
+        self.submitted      = time.time()
+        self.started        = None
+        self.finished       = None
+        self.emit({'event': 'job', 'id': self.id})
+
+    def emit(self, event, wait_for=None):
+        '''
+        Queues event for the client. If wait_for is a Future (such as an image
+        write) the event is held back until it is done, without holding up the
+        caller.
+        '''
+        self.events.put((event, wait_for))
+
+    def cancel(self):
+        if not self.canceled.is_set():
+            self.canceled.set()
+            self.emit({'event': 'canceled'})
+
+    def finish(self):
+        self.finished = time.time()
+        self.state    = 'canceled' if self.canceled.is_set() else 'done'
+        self.events.put(None)
+
+    def status(self) -> dict:
+        return {
+            'id':         self.id,
+            'state':      self.state,
+            'prompt':     self.opt.prompt,
+            'iterations': self.opt.iterations,
+            'submitted':  self.submitted,
+            'started':    self.started,
+            'finished':   self.finished,
+        }
+
+    def iter_events(self):
+        '''Yields the emitted events until the job has finished'''
+        while True:
+            item = self.events.get()
+            if item is None:
+                return
+            event, wait_for = item
+            if wait_for is not None and wait_for.exception() is not None:
+                event = {'event': 'error', 'message': str(wait_for.exception())}
+            yield event
+
+    def batch_key(self):
+        '''Jobs with the same key can be sampled in one batch; None means never batch'''
+        opt = self.opt
+        if opt.init_img is not None or opt.variation_amount > 0 or opt.with_variations:
+            return None
+        return (opt.model, opt.width, opt.height, opt.steps, opt.sampler_name, opt.cfg_scale, opt.seamless)
+
+    def as_request(self):
+        '''Returns the per-request arguments for Generate.prompts2images()'''
+        opt = self.opt
+        return {
+            'prompt':          opt.prompt,
+            'iterations':      opt.iterations,
+            'seed':            opt.seed,
+            'upscale':         opt.upscale,
+            'gfpgan_strength': opt.gfpgan_strength,
+        }
+
+
+class RequestScheduler(threading.Thread):
+    '''
+    Serves GenerationJobs one batch at a time on its own thread. max_batch_size
+    caps the number of images sampled together, with 0 leaving it to the
+    free memory of the device. gather_time is how long to wait for
+    compatible requests to arrive before starting a batch.
+    '''
+    def __init__(self, model, max_batch_size=1, gather_time=0.05, history=50):
+        super().__init__(name='RequestScheduler', daemon=True)
+        self.model          = model
+        self.max_batch_size = max_batch_size
+        self.gather_time    = gather_time
+        self.pending        = []
+        self.running        = []
+        self.recent         = collections.deque(maxlen=history)
+        self.condition      = threading.Condition()
+        # metrics
+        self.jobs_done      = 0
+        self.batches_run    = 0
+        self.images_done    = 0
+        self.batch_sizes    = {}     # requests per batch -> count
+
+    def submit(self, job):
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify()
+        return job
+
+    def cancel(self, job_id=None) -> bool:
+        '''
+        Cancels the job with the given id, or every queued and running job
+        when job_id is None. Returns False if no such job is waiting or running.
+        '''
+        with self.condition:
+            jobs = [j for j in self.pending + self.running if job_id in (None, j.id)]
+            for job in jobs:
+                job.cancel()
+                if job in self.pending:
+                    self.pending.remove(job)
+                    self.recent.append(job)
+                    job.finish()
+        return len(jobs) > 0
+
+    def jobs(self) -> list:
+        '''Status of the running, queued and recently finished jobs'''
+        with self.condition:
+            return [j.status() for j in self.running + self.pending + list(self.recent)]
+
+    def metrics(self) -> dict:
+        with self.condition:
+            batches = max(self.batches_run, 1)
+            return {
+                'queue_depth':           len(self.pending),
+                'running':               len(self.running),
+                'jobs_done':             self.jobs_done,
+                'batches_run':           self.batches_run,
+                'images_done':           self.images_done,
+                'mean_requests_per_batch': sum(n * c for n, c in self.batch_sizes.items()) / batches,
+                'mean_images_per_batch': self.images_done / batches,
+                'requests_per_batch':    {str(n): c for n, c in sorted(self.batch_sizes.items())},
+            }
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            finally:
+                with self.condition:
+                    self.running      = []
+                    self.recent.extend(batch)
+                    self.jobs_done   += len(batch)
+                    self.batches_run += 1
+                    self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                for job in batch:
+                    job.finish()
+
+    def _next_batch(self):
+        with self.condition:
+            while True:
+                while not self.pending:
+                    self.condition.wait()
+                first = self.pending[0]
+                key   = first.batch_key()
+                if key is not None and self.max_batch_size != 1 and self.gather_time > 0:
+                    # give requests that arrive together a chance to share the batch
+                    self.condition.wait(self.gather_time)
+                    if not self.pending or self.pending[0] is not first:
+                        continue    # canceled while we waited
+                break
+            batch  = [self.pending.pop(0)]
+            images = first.opt.iterations
+            if key is not None and self.max_batch_size != 1:
+                for job in list(self.pending):
+                    if job.batch_key() != key:
+                        continue
+                    if self.max_batch_size and images + job.opt.iterations > self.max_batch_size:
+                        continue
+                    self.pending.remove(job)
+                    batch.append(job)
+                    images += job.opt.iterations
+            self.running = batch
+            now = time.time()
+            for job in batch:
+                job.started = now
+                job.state   = 'running'
+            return batch
+
+    def _callbacks(self, job, batch):
+        '''
+        Wraps the job's callbacks so that nothing more is reported once the job
+        is canceled, and the sampler is interrupted at the next step once all
+        the jobs sharing its batch are canceled.
+        '''
+        def step_callback(sample, step):
+            if job.canceled.is_set():
+                if all(j.canceled.is_set() for j in batch):
+                    raise CanceledException
+                return
+            if job.step_callback:
+                job.step_callback(sample, step)
+
+        def image_callback(image, seed, **kwargs):
+            if job.canceled.is_set():
+                return
+            if job.image_callback:
+                job.image_callback(image, seed, **kwargs)
+
+        return step_callback, image_callback
+
+    def _run_batch(self, batch):
+        first = batch[0]
+        try:
+            if first.opt.model:
+                # all the jobs in a batch ask for the same model
+                self.model.switch_model(first.opt.model)
+            if len(batch) == 1:
+                step_callback, image_callback = self._callbacks(first, batch)
+                results = [self.model.prompt2image(
+                    **vars(first.opt),
+                    step_callback  = step_callback,
+                    image_callback = image_callback,
+                )]
+            else:
+                print(f'>> Sampling {len(batch)} requests together')
+                opt     = first.opt
+                requests = []
+                for job in batch:
+                    request = job.as_request()
+                    request['step_callback'], request['image_callback'] = self._callbacks(job, batch)
+                    requests.append(request)
+                results = self.model.prompts2images(
+                    requests,
+                    batch_size   = self.max_batch_size,
+                    steps        = opt.steps,
+                    cfg_scale    = opt.cfg_scale,
+                    width        = opt.width,
+                    height       = opt.height,
+                    sampler_name = opt.sampler_name,
+                    seamless     = opt.seamless,
+                )
+            with self.condition:
+                self.images_done += sum(len(r) for r in results)
+        except CanceledException:
+            print('Canceled.')
+        except (Exception, SystemExit) as e:
+            print(traceback.format_exc(), file=sys.stderr)
+            for job in batch:
+                job.emit({'event': 'error', 'message': str(e)})
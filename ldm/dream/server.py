@@ -3,9 +3,14 @@ import json
 import base64
 import mimetypes
 import os
+import tempfile
+from datetime import datetime
+from omegaconf import OmegaConf
+from urllib.parse import urlparse, parse_qs
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from ldm.dream.pngwriter import PngWriter, PromptFormatter
-from threading import Event
+from ldm.dream.scheduler import GenerationJob, CanceledException
+from ldm.gfpgan.gfpgan_tools import gfpgan_config
 
 def build_opt(post_data, seed, gfpgan_model_exists):
     opt = argparse.Namespace()
@@ -28,6 +33,7 @@ def build_opt(post_data, seed, gfpgan_model_exists):
     setattr(opt, 'seed', None if int(post_data['seed']) == -1 else int(post_data['seed']))
     setattr(opt, 'variation_amount', float(post_data['variation_amount']) if int(post_data['seed']) != -1 else 0)
     setattr(opt, 'with_variations', [])
+    setattr(opt, 'model', post_data.get('model') or None)
 
     broken = False
     if int(post_data['seed']) != -1 and post_data['with_variations'] != '':
@@ -54,13 +60,37 @@ def build_opt(post_data, seed, gfpgan_model_exists):
 
     return opt
 
-class CanceledException(Exception):
-    pass
+def parse_run_log_query(query_string):
+    """
+    Turns the query string of a /run_log.json request into GalleryStore.query()
+    arguments: limit, before and since (image ids), prompt, seed, and from and
+    to, which are dates (YYYY-MM-DD[THH:MM]) or unix times.
+    """
+    params = {k: v[-1] for k, v in parse_qs(query_string).items()}
+    def as_time(value):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+    query = {'limit': min(int(params.get('limit', 100)), 1000)}
+    for key in ('before', 'since', 'seed'):
+        if key in params:
+            query[key] = int(params[key])
+    if 'prompt' in params:
+        query['prompt'] = params['prompt']
+    if 'from' in params:
+        query['start'] = as_time(params['from'])
+    if 'to' in params:
+        query['end'] = as_time(params['to'])
+    return query
 
 class DreamServer(BaseHTTPRequestHandler):
     model = None
     outdir = None
-    canceled = Event()
+    scheduler = None
+    gallery = None
+    intermediate_format = 'png'
+    shard_size = None
 
     def do_GET(self):
         if self.path == "/":
@@ -70,38 +100,47 @@ class DreamServer(BaseHTTPRequestHandler):
             with open("./static/dream_web/index.html", "rb") as content:
                 self.wfile.write(content.read())
         elif self.path == "/config.js":
-            # unfortunately this import can't be at the top level, since that would cause a circular import
-            from ldm.gfpgan.gfpgan_tools import gfpgan_model_exists
             self.send_response(200)
             self.send_header("Content-type", "application/javascript")
             self.end_headers()
             config = {
-                'gfpgan_model_exists': gfpgan_model_exists
+                'gfpgan_model_exists': gfpgan_config.model_exists,
+                'models': list(OmegaConf.load(self.model.models_config)),
+                'model': self.model.model_name,
             }
             self.wfile.write(bytes("let config = " + json.dumps(config) + ";\n", "utf-8"))
-        elif self.path == "/run_log.json":
+        elif self.path == "/run_log.json" or self.path.startswith("/run_log.json?"):
+            try:
+                query = parse_run_log_query(urlparse(self.path).query)
+            except ValueError as e:
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(bytes(json.dumps({"error": str(e)}), "utf-8"))
+                return
+            page = self.gallery.query(**query)
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
-            output = []
-            
-            log_file = os.path.join(self.outdir, "dream_web_log.txt")
-            if os.path.exists(log_file):
-                with open(log_file, "r") as log:
-                    for line in log:
-                        url, config = line.split(": {", maxsplit=1)
-                        config = json.loads("{" + config)
-                        config["url"] = url.lstrip(".")
-                        if os.path.exists(url):
-                            output.append(config)
-
-            self.wfile.write(bytes(json.dumps({"run_log": output}), "utf-8"))
-        elif self.path == "/cancel":
-            self.canceled.set()
-            self.send_response(200)
+            self.wfile.write(bytes(json.dumps(page), "utf-8"))
+        elif self.path == "/cancel" or self.path.startswith("/cancel/"):
+            # a bare /cancel cancels everything that is queued or running
+            job_id = self.path[len("/cancel/"):] or None
+            found = self.scheduler.cancel(job_id)
+            self.send_response(200 if found or job_id is None else 404)
             self.send_header("Content-type", "application/json")
             self.end_headers()
             self.wfile.write(bytes('{}', 'utf8'))
+        elif self.path == "/jobs":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(bytes(json.dumps({"jobs": self.scheduler.jobs()}), 'utf-8'))
+        elif self.path == "/metrics.json":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            metrics = self.scheduler.metrics() if self.scheduler else {}
+            self.wfile.write(bytes(json.dumps(metrics), 'utf-8'))
         else:
             path = "." + self.path
             cwd = os.path.realpath(os.getcwd())
@@ -124,14 +163,10 @@ class DreamServer(BaseHTTPRequestHandler):
         self.send_header("Content-type", "application/json")
         self.end_headers()
 
-        # unfortunately this import can't be at the top level, since that would cause a circular import
-        from ldm.gfpgan.gfpgan_tools import gfpgan_model_exists
-
         content_length = int(self.headers['Content-Length'])
         post_data = json.loads(self.rfile.read(content_length))
-        opt = build_opt(post_data, self.model.seed, gfpgan_model_exists)
+        opt = build_opt(post_data, self.model.seed, gfpgan_config.model_exists)
 
-        self.canceled.clear()
         print(f">> Request to generate with prompt: {opt.prompt}")
         # In order to handle upscaled images, the PngWriter needs to maintain state
         # across images generated by each call to prompt2img(), so we define it in
@@ -141,7 +176,7 @@ class DreamServer(BaseHTTPRequestHandler):
 
         images_generated = 0    # helps keep track of when upscaling is started
         images_upscaled = 0     # helps keep track of when upscaling is completed
-        pngwriter = PngWriter(self.outdir)
+        pngwriter = PngWriter(self.outdir, shard_size=self.shard_size)
 
         prefix = pngwriter.unique_prefix()
         # if upscaling is requested, then this will be called twice, once when
@@ -161,18 +196,17 @@ class DreamServer(BaseHTTPRequestHandler):
             elif opt.with_variations is None:
                 iter_opt.seed = seed
             normalized_prompt = PromptFormatter(self.model, iter_opt).normalize_prompt()
-            path = pngwriter.save_image_and_prompt_to_png(image, f'{normalized_prompt} -S{iter_opt.seed}', name)
+            # the png is written in the background; the result event waits for it
+            written = pngwriter.queue_image_and_prompt(image, f'{normalized_prompt} -S{iter_opt.seed}', name)
+            path = pngwriter.path_for(name)
 
             if int(config['seed']) == -1:
                 config['seed'] = seed
-            # Append post_data to log, but only once!
+            # Add post_data to the gallery, but only once!
             if not upscaled:
-                with open(os.path.join(self.outdir, "dream_web_log.txt"), "a") as log:
-                    log.write(f"{path}: {json.dumps(config)}\n")
+                self.gallery.add(path, seed, config)
 
-                self.wfile.write(bytes(json.dumps(
-                    {'event': 'result', 'url': path, 'seed': seed, 'config': config}
-                ) + '\n',"utf-8"))
+                job.emit({'event': 'result', 'url': path, 'seed': seed, 'config': dict(config)}, wait_for=written)
 
             # control state of the "postprocessing..." message
             upscaling_requested = opt.upscale or opt.gfpgan_strength > 0
@@ -191,51 +225,57 @@ class DreamServer(BaseHTTPRequestHandler):
                         action = 'upscaling-done'
                 if action:
                     x = images_upscaled + 1
-                    self.wfile.write(bytes(json.dumps(
-                        {'event': action, 'processed_file_cnt': f'{x}/{opt.iterations}'}
-                    ) + '\n',"utf-8"))
+                    job.emit({'event': action, 'processed_file_cnt': f'{x}/{opt.iterations}'})
 
         step_writer = PngWriter(os.path.join(self.outdir, "intermediates"))
         step_index = 1
         def image_progress(sample, step):
-            if self.canceled.is_set():
-                self.wfile.write(bytes(json.dumps({'event':'canceled'}) + '\n', 'utf-8'))
-                raise CanceledException
             path = None
             # since rendering images is moderately expensive, only render every 5th image
             # and don't bother with the last one, since it'll render anyway
             nonlocal step_index
             if opt.progress_images and step % 5 == 0 and step < opt.steps - 1:
-                image = self.model.sample_to_image(sample)
-                name = f'{prefix}.{opt.seed}.{step_index}.png'
+                image = self.model.sample_to_image(sample[:1])
+                name = f'{prefix}.{opt.seed}.{step_index}.{self.intermediate_format}'
                 metadata = f'{opt.prompt} -S{opt.seed} [intermediate]'
-                path = step_writer.save_image_and_prompt_to_png(image, metadata, name)
+                written = step_writer.queue_image_and_prompt(image, metadata, name, format=self.intermediate_format)
+                path = os.path.join(step_writer.outdir, name)
                 step_index += 1
-            self.wfile.write(bytes(json.dumps(
-                {'event': 'step', 'step': step + 1, 'url': path}
-            ) + '\n',"utf-8"))
-
-        try:
-            if opt.init_img is None:
-                # Run txt2img
-                self.model.prompt2image(**vars(opt), step_callback=image_progress, image_callback=image_done)
+                job.emit({'event': 'step', 'step': step + 1, 'url': path}, wait_for=written)
             else:
-                # Decode initimg as base64 to temp file
-                with open("./img2img-tmp.png", "wb") as f:
-                    initimg = opt.init_img.split(",")[1] # Ignore mime type
-                    f.write(base64.b64decode(initimg))
-                opt1 = argparse.Namespace(**vars(opt))
-                opt1.init_img = "./img2img-tmp.png"
+                job.emit({'event': 'step', 'step': step + 1, 'url': path})
 
+        # The model is run by the scheduler thread, which may sample this request
+        # together with others. The callbacks above queue their events on the job
+        # and this handler thread writes them to the client as they arrive.
+        # Canceled jobs are handled by the scheduler, so the callbacks don't check.
+        job = GenerationJob(opt, image_callback=image_done, step_callback=image_progress)
+        tmp_path = None
+        if opt.init_img is not None:
+            # Decode initimg as base64 to a temp file of its own
+            fd, tmp_path = tempfile.mkstemp(prefix='img2img-', suffix='.png')
+            with os.fdopen(fd, "wb") as f:
+                initimg = opt.init_img.split(",")[1] # Ignore mime type
+                f.write(base64.b64decode(initimg))
+            job.opt = argparse.Namespace(**vars(opt))
+            job.opt.init_img = tmp_path
+
+        try:
+            self.scheduler.submit(job)
+            connected = True
+            for event in job.iter_events():
+                if not connected:
+                    continue    # keep draining until the job is done
                 try:
-                    # Run img2img
-                    self.model.prompt2image(**vars(opt1), step_callback=image_progress, image_callback=image_done)
-                finally:
-                    # Remove the temp file
-                    os.remove("./img2img-tmp.png")
-        except CanceledException:
-            print(f"Canceled.")
-            return
+                    self.wfile.write(bytes(json.dumps(event) + '\n', 'utf-8'))
+                except OSError:
+                    print(f'>> Client disconnected; canceling job {job.id}')
+                    self.scheduler.cancel(job.id)
+                    connected = False
+        finally:
+            if tmp_path is not None:
+                # Remove the temp file
+                os.remove(tmp_path)
 
 
 class ThreadingDreamServer(ThreadingHTTPServer):
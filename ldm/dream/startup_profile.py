@@ -0,0 +1,109 @@
+'''
+Times the startup of dream.py when it is run with --profile_startup: the
+first import of each module, and the construction of each part of the model
+by ldm.util.instantiate_from_config(), which is wrapped for the purpose as
+soon as ldm.util is imported. Module times are "self" times, leaving out the
+modules that a module imports in turn, so the largest ones are where the
+time actually goes.
+
+This module is imported before anything heavy and must import nothing heavy
+itself.
+'''
+import builtins
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class StartupProfile:
+    def __init__(self):
+        self.active    = False
+        self.timings   = []      # (kind, name, seconds including nested work, seconds excluding it)
+        self._nested   = []      # seconds spent in nested timed work, one entry per open timing
+        self._import   = None    # builtins.__import__ as it was before start()
+        self._thread   = None
+        self._started  = None
+
+    def start(self):
+        '''Starts timing imports and model construction on the calling thread'''
+        if self.active:
+            return
+        self.active   = True
+        self._thread  = threading.get_ident()
+        self._started = time.perf_counter()
+        self._import  = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        if not self.active:
+            return
+        builtins.__import__ = self._import
+        self.active = False
+
+    @contextmanager
+    def timed(self, kind, name):
+        '''Times the enclosed work as kind (import, build or step) under name, if profiling'''
+        if not self.active or threading.get_ident() != self._thread:
+            yield
+            return
+        self._nested.append(0.0)
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - tic
+            nested  = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.timings.append((kind, name, elapsed, elapsed - nested))
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # only first imports take any time; relative imports are named as written
+        if level or name in sys.modules or not self.active:
+            return self._import(name, globals, locals, fromlist, level)
+        with self.timed('import', name):
+            module = self._import(name, globals, locals, fromlist, level)
+        self._wrap_instantiate_from_config()
+        return module
+
+    def _wrap_instantiate_from_config(self):
+        # done right after ldm.util is imported, before any other module
+        # has bound the name, so that every caller gets the wrapped one
+        util = sys.modules.get('ldm.util')
+        instantiate = getattr(util, 'instantiate_from_config', None)
+        if instantiate is None or getattr(instantiate, 'profiled', False):
+            return
+
+        def instantiate_from_config(config, **kwargs):
+            if not isinstance(config, str) and 'target' in config:
+                with self.timed('build', config['target']):
+                    return instantiate(config, **kwargs)
+            return instantiate(config, **kwargs)
+
+        instantiate_from_config.profiled = True
+        util.instantiate_from_config = instantiate_from_config
+
+    def report(self, top=20):
+        '''Prints where the time went, then stops profiling'''
+        self.stop()
+        total    = time.perf_counter() - self._started
+        packages = defaultdict(float)
+        for kind, name, _, own in self.timings:
+            if kind == 'import':
+                packages[name.split('.')[0]] += own
+        imports = sorted((t for t in self.timings if t[0] == 'import'), key=lambda t: -t[3])
+        others  = [t for t in self.timings if t[0] != 'import']
+
+        print(f'>> Startup profile: {total:.2f}s to ready, {sum(packages.values()):.2f}s of it importing modules')
+        print('>>   import time by package:')
+        for package, seconds in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+            print(f'>>     {seconds:8.3f}s  {package}')
+        print(f'>>   slowest {min(top, len(imports))} modules, excluding the modules they import:')
+        for _, name, _, own in imports[:top]:
+            print(f'>>     {own:8.3f}s  {name}')
+        print('>>   model construction and loading, including the imports they trigger:')
+        for kind, name, elapsed, _ in others:
+            print(f'>>     {elapsed:8.3f}s  {kind} {name}')
+
+startup_profile = StartupProfile()
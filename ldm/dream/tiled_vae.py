@@ -0,0 +1,102 @@
+'''
+Decodes latents to images, and encodes images to latents, a tile at a time
+so that the autoencoder's memory use doesn't grow with the image size.
+
+Tiles overlap and are blended with weights that ramp down across the
+overlap, which hides the seams between them. The weights for each tile
+shape are computed once and reused.
+'''
+import torch
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+
+downsampling = 8
+
+class TiledVAE:
+    def __init__(self, model, tile_size=512, overlap=64):
+        '''
+        tile_size and overlap are in image pixels, and must be multiples of 8.
+        Images that fit in one tile are encoded and decoded whole.
+        '''
+        assert tile_size % downsampling == 0 and overlap % downsampling == 0, \
+            '--vae_tile_size and --vae_tile_overlap must be multiples of 8'
+        assert 0 <= overlap < tile_size // 2, '--vae_tile_overlap must be less than half of --vae_tile_size'
+        self.model     = model
+        self.tile_size = tile_size
+        self.overlap   = overlap
+        self.weights   = {}
+
+    def decode(self, z):
+        '''Same as model.decode_first_stage(z), a tile at a time'''
+        f        = downsampling
+        tile     = self.tile_size // f
+        overlap  = self.overlap // f
+        b, _, h, w = z.shape
+        if h <= tile and w <= tile:
+            return self.model.decode_first_stage(z)
+
+        out = total = None
+        for y in self._starts(h, tile, overlap):
+            for x in self._starts(w, tile, overlap):
+                decoded = self.model.decode_first_stage(z[:, :, y:y+tile, x:x+tile])
+                if out is None:
+                    out   = torch.zeros(b, decoded.shape[1], h*f, w*f, device=z.device)
+                    total = torch.zeros(1, 1, h*f, w*f, device=z.device)
+                weight = self._weight(decoded.shape[2], decoded.shape[3], self.overlap, z.device)
+                out  [:, :, y*f:y*f+decoded.shape[2], x*f:x*f+decoded.shape[3]] += decoded.float() * weight
+                total[:, :, y*f:y*f+decoded.shape[2], x*f:x*f+decoded.shape[3]] += weight
+                del decoded
+        return (out / total).to(z.dtype)
+
+    def encode(self, x):
+        '''
+        Same as model.encode_first_stage(x), a tile at a time. For autoencoders
+        that return a DiagonalGaussianDistribution, its parameters are blended
+        and a distribution over the whole latent is returned.
+        '''
+        f        = downsampling
+        tile     = self.tile_size
+        overlap  = self.overlap
+        b, _, h, w = x.shape
+        if h <= tile and w <= tile:
+            return self.model.encode_first_stage(x)
+        assert h % f == 0 and w % f == 0, f'images must be a multiple of {f} pixels to be encoded in tiles'
+
+        out = total = None
+        is_distribution = False
+        for y in self._starts(h, tile, overlap):
+            for x0 in self._starts(w, tile, overlap):
+                encoded = self.model.encode_first_stage(x[:, :, y:y+tile, x0:x0+tile])
+                if isinstance(encoded, DiagonalGaussianDistribution):
+                    is_distribution = True
+                    encoded = encoded.parameters
+                if out is None:
+                    out   = torch.zeros(b, encoded.shape[1], h//f, w//f, device=x.device)
+                    total = torch.zeros(1, 1, h//f, w//f, device=x.device)
+                weight = self._weight(encoded.shape[2], encoded.shape[3], overlap // f, x.device)
+                out  [:, :, y//f:y//f+encoded.shape[2], x0//f:x0//f+encoded.shape[3]] += encoded.float() * weight
+                total[:, :, y//f:y//f+encoded.shape[2], x0//f:x0//f+encoded.shape[3]] += weight
+                del encoded
+        out = (out / total).to(x.dtype)
+        return DiagonalGaussianDistribution(out) if is_distribution else out
+
+    # tile offsets covering length, the last one flush with the end
+    @staticmethod
+    def _starts(length, tile, overlap):
+        if length <= tile:
+            return [0]
+        stride = tile - overlap
+        return list(range(0, length - tile, stride)) + [length - tile]
+
+    # feathered blending weights for an h x w tile: 1 in the middle, falling
+    # off linearly across the overlap at each edge, never quite reaching 0
+    def _weight(self, h, w, overlap, device):
+        key = (h, w, overlap, str(device))
+        if key not in self.weights:
+            def ramp(n):
+                i = torch.arange(n, dtype=torch.float32, device=device)
+                return torch.minimum(
+                    torch.ones_like(i),
+                    torch.minimum(i + 1, n - i) / (overlap + 1),
+                )
+            self.weights[key] = (ramp(h)[:, None] * ramp(w)[None, :])[None, None]
+        return self.weights[key]
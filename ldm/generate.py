@@ -6,7 +6,6 @@
 
 import torch
 import numpy as np
-import random
 import os
 import time
 import re
@@ -14,19 +13,22 @@ import sys
 import traceback
 import transformers
 
+from collections import OrderedDict
 from omegaconf import OmegaConf
 from PIL import Image, ImageOps
 from torch import nn
-from pytorch_lightning import seed_everything
 
 from ldm.util                      import instantiate_from_config
-from ldm.models.diffusion.ddim     import DDIMSampler
-from ldm.models.diffusion.plms     import PLMSSampler
-from ldm.models.diffusion.ksampler import KSampler
 from ldm.dream.pngwriter           import PngWriter
 from ldm.dream.image_util          import InitImageResizer
-from ldm.dream.devices             import choose_torch_device
-from ldm.dream.conditioning        import get_uc_and_c
+from ldm.dream.devices             import choose_torch_device, choose_autocast_device, choose_batch_size
+from ldm.dream.conditioning        import get_uc_and_c, conditioning_cache
+from ldm.dream.model_cache         import ModelCache
+from ldm.dream.postprocess         import PostprocessPipeline
+from ldm.modules.attention         import set_attention_backend, set_attention_memory_budget
+
+# samplers kept with their schedules made, for requests with the same settings
+SAMPLER_CACHE_SIZE = 8
 
 """Simplified text to image API for stable diffusion/latent diffusion
 
@@ -89,8 +91,24 @@ gr = Generate(
           width       = <integer>     // image width, multiple of 64 (512)
           height      = <integer>     // image height, multiple of 64 (512)
           cfg_scale   = <float>       // condition-free guidance scale (7.5)
+          cfg_truncation = <float>    // fraction of the final steps run without the unconditional half of cfg (0.0)
+          postprocess_workers = <integer> // threads upscaling and restoring faces while the next images are sampled (1)
+          batch_size  = <integer>     // images sampled together per batch, 0 to size batches to free memory (1)
+          model_name  = <string>      // name of the model in models_config that weights and config belong to
+          models_config = <path>      // configuration file listing the models switch_model() can load ('configs/models.yaml')
+          model_cache_gb = <float>    // memory allowed for models kept loaded for switch_model() (12.0)
+          park_models = <boolean>     // move inactive models to CPU memory (true)
+          mmap_weights = <boolean>    // load weights from a memory-mapped copy of the checkpoint, made on first use (false)
+          inference_snapshots = <boolean> // load the inference snapshot exported beside the checkpoint, if there is one (false)
+          attention_backend = <string> // 'auto', 'einsum', 'sliced', 'flash' or 'sdp' (where torch has it) ('auto')
+          attention_memory_gb = <float> // memory the attention score matrices may use; measured from free memory if not given
+          vae_tile_size = <integer>   // encode and decode images larger than this many pixels a tile at a time (None)
+          vae_tile_overlap = <integer> // pixels by which those tiles overlap (64)
           )
 
+To change models, call switch_model() with the name of an entry in models_config.
+Models that have been used recently are kept in memory, so switching back is quick.
+
 """
 
 
@@ -102,6 +120,7 @@ class Generate:
     def __init__(
             self,
             iterations            = 1,
+            batch_size            = 1,
             steps                 = 50,
             cfg_scale             = 7.5,
             weights               = 'models/ldm/stable-diffusion-v1/model.ckpt',
@@ -118,8 +137,21 @@ class Generate:
             embedding_path        = None,
             device_type           = 'cuda',
             ignore_ctrl_c         = False,
+            model_name            = None,
+            models_config         = 'configs/models.yaml',
+            model_cache_gb        = 12.0,
+            park_models           = True,
+            mmap_weights          = False,
+            inference_snapshots   = False,
+            attention_backend     = 'auto',
+            attention_memory_gb   = None,
+            vae_tile_size         = None,
+            vae_tile_overlap      = 64,
+            cfg_truncation        = 0.0,
+            postprocess_workers   = 1,
     ):
         self.iterations               = iterations
+        self.batch_size               = batch_size
         self.width                    = width
         self.height                   = height
         self.steps                    = steps
@@ -136,13 +168,27 @@ class Generate:
         self.embedding_path           = embedding_path
         self.device_type              = device_type
         self.ignore_ctrl_c            = ignore_ctrl_c    # note, this logic probably doesn't belong here...
+        self.model_name               = model_name
+        self.models_config            = models_config
+        self.mmap_weights             = mmap_weights
+        self.inference_snapshots      = inference_snapshots
+        self.attention_backend        = attention_backend
+        self.vae_tile_size            = vae_tile_size
+        self.vae_tile_overlap         = vae_tile_overlap
+        self.cfg_truncation           = cfg_truncation
+        self.postprocess_workers      = postprocess_workers
+        self.model_cache              = ModelCache(max_gb=model_cache_gb, park_on_cpu=park_models)
         self.model                    = None     # empty for now
         self.sampler                  = None
+        self.samplers                 = OrderedDict()   # (name, steps, eta, device, dtype) -> sampler
         self.device                   = None
         self.generators               = {}
         self.base_generator           = None
         self.seed                     = None
 
+        if attention_memory_gb is not None:
+            set_attention_memory_budget(int(attention_memory_gb * 2**30))
+
         if device_type == 'cuda' and not torch.cuda.is_available():
             device_type = choose_torch_device()
             print(">> cuda not available, using device", device_type)
@@ -186,9 +232,11 @@ class Generate:
             # these are common
             prompt,
             iterations     =    None,
+            batch_size     =    None,
             steps          =    None,
             seed           =    None,
             cfg_scale      =    None,
+            cfg_truncation =    None,
             ddim_eta       =    None,
             skip_normalize =    False,
             image_callback =    None,
@@ -216,11 +264,13 @@ class Generate:
         It takes the following arguments:
            prompt                          // prompt string (no default)
            iterations                      // iterations (1); image count=iterations
+           batch_size                      // how many of the iterations to sample together (1); 0 chooses a batch size that fits in free memory
            steps                           // refinement steps per iteration
            seed                            // seed for random number generator
            width                           // width of image, in multiples of 64 (512)
            height                          // height of image, in multiples of 64 (512)
            cfg_scale                       // how strongly the prompt influences the image (7.5) (must be >1)
+           cfg_truncation                  // fraction of the final steps to run without the unconditional branch of cfg (0.0)
            seamless                        // whether the generated image should tile
            init_img                        // path to an initial image
            strength                        // strength for noising/unnoising init_img. 0.0 preserves image exactly, 1.0 replaces it completely
@@ -252,8 +302,10 @@ class Generate:
         height                = height     or self.height
         seamless              = seamless   or self.seamless
         cfg_scale             = cfg_scale  or self.cfg_scale
+        cfg_truncation        = self.cfg_truncation if cfg_truncation is None else cfg_truncation
         ddim_eta              = ddim_eta   or self.ddim_eta
         iterations            = iterations or self.iterations
+        batch_size            = self.batch_size if batch_size is None else batch_size
         strength              = strength   or self.strength
         self.seed             = seed
         self.log_tokenization = log_tokenization
@@ -298,6 +350,7 @@ class Generate:
         results          = list()
         init_image       = None
         mask_image       = None
+        pipeline         = None
 
         try:
             uc, c = get_uc_and_c(
@@ -308,6 +361,12 @@ class Generate:
 
             (init_image,mask_image) = self._make_images(init_img,init_mask, width, height, fit)
             
+            if init_image is not None and self.sampler_name == 'plms':
+                print(">> sampler 'plms' is not yet supported for img2img and inpainting. Using ddim")
+                sampler = self._get_sampler('ddim', steps, ddim_eta)
+            else:
+                sampler = self._get_sampler(self.sampler_name, steps, ddim_eta)
+
             if (init_image is not None) and (mask_image is not None):
                 generator = self._make_inpaint()
             elif init_image is not None:
@@ -315,17 +374,30 @@ class Generate:
             else:
                 generator = self._make_txt2img()
 
+            # upscaling and face restoration run alongside the sampling of the next images
+            if upscale is not None or gfpgan_strength > 0:
+                pipeline = self._postprocess_pipeline(upscale, gfpgan_strength, image_callback)
+            if pipeline is not None:
+                def postprocess_callback(image, seed):
+                    if image_callback is not None:
+                        image_callback(image, seed)
+                    pipeline.submit(image, seed)
+            else:
+                postprocess_callback = image_callback
+
             generator.set_variation(self.seed, variation_amount, with_variations)
             results = generator.generate(
                 prompt,
                 iterations     = iterations,
+                batch_size     = batch_size,
                 seed           = self.seed,
-                sampler        = self.sampler,
+                sampler        = sampler,
                 steps          = steps,
                 cfg_scale      = cfg_scale,
+                cfg_truncation = cfg_truncation,
                 conditioning   = (uc,c),
                 ddim_eta       = ddim_eta,
-                image_callback = image_callback,  # called after the final image is generated
+                image_callback = postprocess_callback,  # called after the final image is generated
                 step_callback  = step_callback,   # called after each intermediate image is generated
                 width          = width,
                 height         = height,
@@ -334,12 +406,11 @@ class Generate:
                 strength       = strength,
             )
 
-            if upscale is not None or gfpgan_strength > 0:
-                self.upscale_and_reconstruct(results,
-                                             upscale        = upscale,
-                                             strength       = gfpgan_strength,
-                                             save_original  = save_original,
-                                             image_callback = image_callback)
+            if pipeline is not None:
+                upscaled, pipeline = pipeline.finish(), None
+                if image_callback is None:
+                    for r, image in zip(results, upscaled):
+                        r[0] = image
 
         except KeyboardInterrupt:
             print('*interrupted*')
@@ -351,11 +422,171 @@ class Generate:
         except RuntimeError as e:
             print(traceback.format_exc(), file=sys.stderr)
             print('>> Could not generate image.')
+        finally:
+            if pipeline is not None:
+                pipeline.cancel()
+
+        self._print_usage_stats(len(results), tic)
+        return results
+
+    def prompts2images(
+            self,
+            requests,
+            batch_size     =    None,
+            steps          =    None,
+            cfg_scale      =    None,
+            cfg_truncation =    None,
+            ddim_eta       =    None,
+            width          =    None,
+            height         =    None,
+            sampler_name   =    None,
+            seamless       =    False,
+            **args,
+    ):
+        """
+        Generates the images for several txt2img requests at once, sampling
+        the images of different requests together in the same batches. All the
+        requests share the steps, cfg_scale, cfg_truncation, ddim_eta, width, height,
+        sampler_name and seamless arguments. Each request is a dict of its own:
+           prompt                          // prompt string (no default)
+           iterations                      // image count (1)
+           seed                            // seed of the first image
+           skip_normalize, log_tokenization
+           image_callback, step_callback   // as for prompt2image(), but only called with this request's images
+           upscale, gfpgan_strength, save_original
+
+        The step_callback of a request receives only its own rows of the batch.
+        Returns a list holding the [[image, seed], ...] results of each request.
+        Errors are raised to the caller rather than reported.
+        """
+        steps                 = steps      or self.steps
+        width                 = width      or self.width
+        height                = height     or self.height
+        seamless              = seamless   or self.seamless
+        cfg_scale             = cfg_scale  or self.cfg_scale
+        cfg_truncation        = self.cfg_truncation if cfg_truncation is None else cfg_truncation
+        ddim_eta              = ddim_eta   or self.ddim_eta
+        batch_size            = self.batch_size if batch_size is None else batch_size
+
+        model = self.load_model()
+        for m in model.modules():
+            if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
+                m.padding_mode = 'circular' if seamless else m._orig_padding_mode
+
+        assert cfg_scale > 1.0, 'CFG_Scale (-C) must be >1.0'
+        width, height, _ = self._resolution_check(width, height, log=True)
+
+        if sampler_name and (sampler_name != self.sampler_name):
+            self.sampler_name = sampler_name
+            self._set_sampler()
+
+        tic = time.time()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+        sampler   = self._get_sampler(self.sampler_name, steps, ddim_eta)
+        generator = self._make_txt2img()
+        generator.set_variation(None, 0, [])
+        if not batch_size or batch_size < 1:
+            batch_size = choose_batch_size(self.device, width, height, self.full_precision)
+
+        # one row per image to generate, in request order
+        conditioning = []
+        rows         = []
+        for index, request in enumerate(requests):
+            conditioning.append(get_uc_and_c(
+                request['prompt'], model=self.model,
+                skip_normalize=request.get('skip_normalize', False),
+                log_tokens=request.get('log_tokenization', False),
+            ))
+            rows.extend([index] * (request.get('iterations') or 1))
+
+        # each request's upscaling and face restoration overlap with the batches that follow
+        pipelines = [None] * len(requests)
+        for index, request in enumerate(requests):
+            upscale         = request.get('upscale')
+            gfpgan_strength = request.get('gfpgan_strength') or 0
+            if upscale is not None or gfpgan_strength > 0:
+                pipelines[index] = self._postprocess_pipeline(
+                    upscale, gfpgan_strength, request.get('image_callback')
+                )
+
+        results    = [[] for request in requests]
+        next_seeds = [request.get('seed') for request in requests]
+        device_type, scope = choose_autocast_device(self.device)
+        try:
+            with scope(device_type), model.ema_scope():
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    seeds = []
+                    for index in batch:
+                        seed = next_seeds[index] or generator.new_seed()
+                        next_seeds[index] = generator.next_seed(seed)
+                        seeds.append(seed)
+
+                    # hand each request's callback only its own rows of the batch
+                    spans = {}
+                    for row, index in enumerate(batch):
+                        first, _ = spans.get(index, (row, row))
+                        spans[index] = (first, row + 1)
+
+                    def step_callback(sample, step):
+                        for index, (first, last) in spans.items():
+                            callback = requests[index].get('step_callback')
+                            if callback is not None:
+                                callback(sample[first:last], step)
+
+                    make_image = generator.get_make_image(
+                        None,
+                        sampler       = sampler,
+                        steps         = steps,
+                        cfg_scale     = cfg_scale,
+                        cfg_truncation = cfg_truncation,
+                        ddim_eta      = ddim_eta,
+                        conditioning  = (
+                            torch.cat([conditioning[index][0] for index in batch]),
+                            torch.cat([conditioning[index][1] for index in batch]),
+                        ),
+                        width         = width,
+                        height        = height,
+                        step_callback = step_callback,
+                    )
+                    generators = [generator.noise_generator(seed) for seed in seeds]
+                    noise      = generator.get_noise_for_seeds(seeds, width, height, generators=generators)
+                    images     = make_image(noise, generator=generators)
+                    for image, seed, index in zip(images, seeds, batch):
+                        results[index].append([image, seed])
+                        callback = requests[index].get('image_callback')
+                        if callback is not None:
+                            callback(image, seed)
+                        if pipelines[index] is not None:
+                            pipelines[index].submit(image, seed)
+
+            for pipeline, request, request_results in zip(pipelines, requests, results):
+                if pipeline is None:
+                    continue
+                upscaled = pipeline.finish()
+                if request.get('image_callback') is None:
+                    for r, image in zip(request_results, upscaled):
+                        r[0] = image
+        finally:
+            for pipeline in pipelines:
+                if pipeline is not None:
+                    pipeline.cancel()
+
+        self._print_usage_stats(len(rows), tic)
+        return results
 
+    def _print_usage_stats(self, image_count, tic):
         toc = time.time()
         print('>> Usage stats:')
         print(
-            f'>>   {len(results)} image(s) generated in', '%4.2fs' % (toc - tic)
+            f'>>   {image_count} image(s) generated in', '%4.2fs' % (toc - tic)
+        )
+        cache_stats = conditioning_cache.stats()
+        print(
+            f'>>   Prompt embedding cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses,',
+            f'{cache_stats["entries"]} entries'
         )
         if torch.cuda.is_available() and self.device.type == 'cuda':
             print(
@@ -372,7 +603,6 @@ class Generate:
                 f'>>   Max VRAM used since script start: ',
                 '%4.2fG' % (self.session_peakmem / 1e9),
             )
-        return results
 
     def _make_images(self, img_path, mask_path, width, height, fit=False):
         init_image      = None
@@ -402,54 +632,118 @@ class Generate:
     def _make_img2img(self):
         if not self.generators.get('img2img'):
             from ldm.dream.generator.img2img import Img2Img
-            self.generators['img2img'] = Img2Img(self.model)
+            self.generators['img2img'] = self._configure_generator(Img2Img(self.model))
         return self.generators['img2img']
 
     def _make_txt2img(self):
         if not self.generators.get('txt2img'):
             from ldm.dream.generator.txt2img import Txt2Img
-            self.generators['txt2img'] = Txt2Img(self.model)
+            self.generators['txt2img'] = self._configure_generator(Txt2Img(self.model))
         return self.generators['txt2img']
 
     def _make_inpaint(self):
         if not self.generators.get('inpaint'):
             from ldm.dream.generator.inpaint import Inpaint
-            self.generators['inpaint'] = Inpaint(self.model)
+            self.generators['inpaint'] = self._configure_generator(Inpaint(self.model))
         return self.generators['inpaint']
 
+    def _configure_generator(self, generator):
+        if self.vae_tile_size:
+            from ldm.dream.tiled_vae import TiledVAE
+            generator.tiled_vae = TiledVAE(self.model, self.vae_tile_size, self.vae_tile_overlap)
+        return generator
+
     def load_model(self):
         """Load and initialize the model from configuration variables passed at object creation time"""
         if self.model is None:
-            seed_everything(random.randrange(0, np.iinfo(np.uint32).max))
-            try:
-                config = OmegaConf.load(self.config)
-                model = self._load_model_from_config(config, self.weights)
-                if self.embedding_path is not None:
-                    model.embedding_manager.load(
-                        self.embedding_path, self.full_precision
-                    )
-                self.model = model.to(self.device)
-                # model.to doesn't change the cond_stage_model.device used to move the tokenizer output, so set it here
-                self.model.cond_stage_model.device = self.device
-            except AttributeError as e:
-                print(f'>> Error loading model. {str(e)}', file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-                raise SystemExit from e
-
+            self.model = self.model_cache.get(
+                self.model_name or self.weights, self._load_model, self.device
+            )
+            set_attention_backend(self.model, self.attention_backend)
+            # samplers hold the model they were made for
+            self.samplers.clear()
             self._set_sampler()
 
-            for m in self.model.modules():
-                if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
-                    m._orig_padding_mode = m.padding_mode
-
         return self.model
 
+    def switch_model(self, model_name):
+        """
+        Makes the model called model_name in models_config the current one,
+        loading it or taking it from the model cache. The default width and
+        height change to the new model's.
+        """
+        if model_name == self.model_name and self.model is not None:
+            return self.model
+        models = OmegaConf.load(self.models_config)
+        assert model_name in models, f'>> "{model_name}" is not a model in {self.models_config}'
+        previous = (self.model_name, self.config, self.weights, self.width, self.height)
+        entry    = models[model_name]
+
+        print(f'>> Switching to model {model_name}')
+        self.model_name     = model_name
+        self.config         = entry.config
+        self.weights        = entry.weights
+        self.width          = entry.width
+        self.height         = entry.height
+        self.model          = None
+        self.sampler        = None
+        self.generators     = {}
+        self.base_generator = None
+        try:
+            return self.load_model()
+        except (Exception, SystemExit):
+            # go back to the model we had
+            self.model_name, self.config, self.weights, self.width, self.height = previous
+            self.model_cache.drop(model_name)
+            self.load_model()
+            raise
+
+    def _load_model(self):
+        try:
+            model = self._load_model_from_config(self.config, self.weights)
+            if self.embedding_path is not None:
+                model.embedding_manager.load(
+                    self.embedding_path, self.full_precision
+                )
+            model = model.to(self.device)
+            # model.to doesn't change the cond_stage_model.device used to move the tokenizer output, so set it here
+            model.cond_stage_model.device = self.device
+        except AttributeError as e:
+            print(f'>> Error loading model. {str(e)}', file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            raise SystemExit from e
+
+        for m in model.modules():
+            if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
+                m._orig_padding_mode = m.padding_mode
+
+        return model
+
     def upscale_and_reconstruct(self,
                                 image_list,
                                 upscale       = None,
                                 strength      =  0.0,
                                 save_original = False,
                                 image_callback = None):
+        pipeline = self._postprocess_pipeline(upscale, strength, image_callback)
+        if pipeline is None:
+            return
+        try:
+            for image, seed in image_list:
+                pipeline.submit(image, seed)
+            upscaled = pipeline.finish()
+        except BaseException:
+            pipeline.cancel()
+            raise
+        if image_callback is None:
+            for r, image in zip(image_list, upscaled):
+                r[0] = image
+
+    def _postprocess_pipeline(self, upscale, strength, image_callback):
+        """
+        Returns a PostprocessPipeline that upscales and restores the faces of the
+        images submitted to it, or None if ESRGAN or GFPGAN can't be imported
+        """
         try:
             if upscale is not None:
                 from ldm.gfpgan.gfpgan_tools import real_esrgan_upscale
@@ -458,33 +752,26 @@ class Generate:
         except (ModuleNotFoundError, ImportError):
             print(traceback.format_exc(), file=sys.stderr)
             print('>> You may need to install the ESRGAN and/or GFPGAN modules')
-            return
-            
-        for r in image_list:
-            image, seed = r
-            try:
-                if upscale is not None:
-                    if len(upscale) < 2:
-                        upscale.append(0.75)
-                    image = real_esrgan_upscale(
-                        image,
-                        upscale[1],
-                        int(upscale[0]),
-                        seed,
-                    )
-                if strength > 0:
-                    image = run_gfpgan(
-                        image, strength, seed, 1
-                    )
-            except Exception as e:
-                print(
-                    f'>> Error running RealESRGAN or GFPGAN. Your image was not upscaled.\n{e}'
+            return None
+
+        if upscale is not None and len(upscale) < 2:
+            upscale = list(upscale) + [0.75]
+
+        def process(image, seed):
+            if upscale is not None:
+                image = real_esrgan_upscale(
+                    image,
+                    upscale[1],
+                    int(upscale[0]),
+                    seed,
                 )
+            if strength > 0:
+                image = run_gfpgan(
+                    image, strength, seed, 1
+                )
+            return image
 
-            if image_callback is not None:
-                image_callback(image, seed, upscaled=True)
-            else:
-                r[0] = image
+        return PostprocessPipeline(process, image_callback, workers=self.postprocess_workers)
 
     # to help WebGUI - front end to generator util function
     def sample_to_image(self,samples):
@@ -493,40 +780,57 @@ class Generate:
     def _sample_to_image(self,samples):
         if not self.base_generator:
             from ldm.dream.generator import Generator
-            self.base_generator = Generator(self.model)
+            self.base_generator = self._configure_generator(Generator(self.model))
         return self.base_generator.sample_to_image(samples)
 
     def _set_sampler(self):
-        msg = f'>> Setting Sampler to {self.sampler_name}'
-        if self.sampler_name == 'plms':
-            self.sampler = PLMSSampler(self.model, device=self.device)
-        elif self.sampler_name == 'ddim':
-            self.sampler = DDIMSampler(self.model, device=self.device)
-        elif self.sampler_name == 'k_dpm_2_a':
-            self.sampler = KSampler(
-                self.model, 'dpm_2_ancestral', device=self.device
-            )
-        elif self.sampler_name == 'k_dpm_2':
-            self.sampler = KSampler(self.model, 'dpm_2', device=self.device)
-        elif self.sampler_name == 'k_euler_a':
-            self.sampler = KSampler(
-                self.model, 'euler_ancestral', device=self.device
-            )
-        elif self.sampler_name == 'k_euler':
-            self.sampler = KSampler(self.model, 'euler', device=self.device)
-        elif self.sampler_name == 'k_heun':
-            self.sampler = KSampler(self.model, 'heun', device=self.device)
-        elif self.sampler_name == 'k_lms':
-            self.sampler = KSampler(self.model, 'lms', device=self.device)
-        else:
-            msg = f'>> Unsupported Sampler: {self.sampler_name}, Defaulting to plms'
-            self.sampler = PLMSSampler(self.model, device=self.device)
-
-        print(msg)
-
-    def _load_model_from_config(self, config, ckpt):
-        print(f'>> Loading model from {ckpt}')
+        print(f'>> Setting Sampler to {self.sampler_name}')
+        self.sampler = self._get_sampler(self.sampler_name, self.steps, self.ddim_eta)
 
+    def _get_sampler(self, sampler_name, steps, ddim_eta):
+        """
+        Returns the sampler called sampler_name with its schedule made for steps
+        and ddim_eta. Samplers are kept for later requests with the same settings,
+        so those don't make the schedule again.
+        """
+        key = (sampler_name, steps, ddim_eta, str(self.model.device), self.model.dtype)
+        if key in self.samplers:
+            self.samplers.move_to_end(key)
+            return self.samplers[key]
+        sampler = self._make_sampler(sampler_name)
+        sampler.make_schedule(ddim_num_steps=steps, ddim_eta=ddim_eta, verbose=False)
+        self.samplers[key] = sampler
+        while len(self.samplers) > SAMPLER_CACHE_SIZE:
+            self.samplers.popitem(last=False)
+        return sampler
+
+    def _make_sampler(self, sampler_name):
+        # imported here so that k_diffusion is only loaded by those who use it
+        from ldm.models.diffusion.ddim     import DDIMSampler
+        from ldm.models.diffusion.plms     import PLMSSampler
+        if sampler_name.startswith('k_'):
+            from ldm.models.diffusion.ksampler import KSampler
+
+        if sampler_name == 'plms':
+            return PLMSSampler(self.model, device=self.device)
+        elif sampler_name == 'ddim':
+            return DDIMSampler(self.model, device=self.device)
+        elif sampler_name == 'k_dpm_2_a':
+            return KSampler(self.model, 'dpm_2_ancestral', device=self.device)
+        elif sampler_name == 'k_dpm_2':
+            return KSampler(self.model, 'dpm_2', device=self.device)
+        elif sampler_name == 'k_euler_a':
+            return KSampler(self.model, 'euler_ancestral', device=self.device)
+        elif sampler_name == 'k_euler':
+            return KSampler(self.model, 'euler', device=self.device)
+        elif sampler_name == 'k_heun':
+            return KSampler(self.model, 'heun', device=self.device)
+        elif sampler_name == 'k_lms':
+            return KSampler(self.model, 'lms', device=self.device)
+        print(f'>> Unsupported Sampler: {sampler_name}, Defaulting to plms')
+        return PLMSSampler(self.model, device=self.device)
+
+    def _load_model_from_config(self, config_path, ckpt):
         # for usage statistics
         device_type = choose_torch_device()
         if device_type == 'cuda':
@@ -534,10 +838,19 @@ class Generate:
         tic = time.time()
 
         # this does the work
-        pl_sd = torch.load(ckpt, map_location='cpu')
-        sd = pl_sd['state_dict']
-        model = instantiate_from_config(config.model)
-        m, u = model.load_state_dict(sd, strict=False)
+        model    = None
+        snapshot = self._inference_snapshot(ckpt)
+        if snapshot is not None:
+            model = self._load_model_from_snapshot(snapshot, fall_back=snapshot != ckpt)
+        if model is None:
+            print(f'>> Loading model from {ckpt}')
+            config = OmegaConf.load(config_path)
+            model  = self._load_model_from_flat_weights(config, ckpt) if self.mmap_weights else None
+            if model is None:
+                pl_sd = torch.load(ckpt, map_location='cpu')
+                sd = pl_sd['state_dict']
+                model = instantiate_from_config(config.model)
+                m, u = model.load_state_dict(sd, strict=False)
         
         if self.full_precision:
             print(
@@ -566,6 +879,57 @@ class Generate:
 
         return model
 
+    # Returns the inference snapshot to load in place of ckpt: ckpt itself if it
+    # is one, or with inference_snapshots the one exported beside it if that is
+    # at least as new. Only asked for, because its EMA weights give different
+    # images from the checkpoint's.
+    def _inference_snapshot(self, ckpt):
+        from ldm.dream.flat_weights import inference_snapshot_path, is_inference_snapshot
+        if is_inference_snapshot(ckpt):
+            return ckpt
+        path = inference_snapshot_path(ckpt, half=not self.full_precision)
+        if not os.path.exists(path):
+            return None
+        if not self.inference_snapshots:
+            print(f'>> Not using the inference snapshot {path}; use --inference_snapshot to load it instead')
+            return None
+        if os.path.exists(ckpt) and os.path.getmtime(path) < os.path.getmtime(ckpt):
+            print(f'>> {path} is older than {ckpt}, so it is not used. Export it again to update it')
+            return None
+        return path
+
+    # With fall_back, returns None if the snapshot can't be loaded, so that the
+    # checkpoint it was exported from is loaded instead.
+    def _load_model_from_snapshot(self, path, fall_back=False):
+        from ldm.dream.flat_weights import load_inference_snapshot, read_flat_weights_metadata
+        print(f'>> Loading model from the inference snapshot {path}')
+        try:
+            if read_flat_weights_metadata(path).get('ema') == 'True':
+                print('>> The snapshot has the EMA weights of its checkpoint, so images will differ from those of the checkpoint itself')
+            model, _ = load_inference_snapshot(path)
+        except Exception as e:
+            if not fall_back:
+                raise
+            print(f'>> Could not load the inference snapshot ({e})')
+            return None
+        if self.full_precision and next(model.parameters()).dtype == torch.float16:
+            print('>> This inference snapshot is half precision; converting it for --full_precision')
+            model.float()
+        return model
+
+    # Maps the weights in from a flat tensor file, converting the checkpoint to
+    # one the first time. Returns None if that can't be done.
+    def _load_model_from_flat_weights(self, config, ckpt):
+        from ldm.dream.flat_weights import flat_weights_path, convert_checkpoint, load_model_from_flat_weights
+        path = flat_weights_path(ckpt, half=not self.full_precision)
+        try:
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(ckpt):
+                convert_checkpoint(ckpt, path, half=not self.full_precision)
+            return load_model_from_flat_weights(config, path)
+        except Exception as e:
+            print(f'>> Could not use memory-mapped weights ({e}); loading {ckpt} instead')
+            return None
+
     def _load_img(self, path, width, height, fit=False):
         assert os.path.exists(path), f'>> {path}: File not found'
 
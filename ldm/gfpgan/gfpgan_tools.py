@@ -2,15 +2,81 @@ import torch
 import warnings
 import os
 import sys
+import threading
+import time
 import numpy as np
 
 from PIL import Image
-from scripts.dream import create_argv_parser
 
-arg_parser = create_argv_parser()
-opt        = arg_parser.parse_args()
-model_path          = os.path.join(opt.gfpgan_dir, opt.gfpgan_model_path)
-gfpgan_model_exists = os.path.isfile(model_path)
+class GFPGANConfig:
+    '''
+    Where to find GFPGAN and its model, and how Real-ESRGAN upscales. The
+    defaults match those of the dream.py --gfpgan_* switches, which set them
+    with configure(). The gfpgan, basicsr and realesrgan modules themselves
+    are only imported when a model is first loaded.
+    '''
+    def __init__(self):
+        self.configure()
+
+    def configure(
+            self,
+            gfpgan_dir   = './src/gfpgan',
+            model_path   = 'experiments/pretrained_models/GFPGANv1.3.pth',
+            bg_upsampler = 'realesrgan',
+            bg_tile      = 400,
+    ):
+        self.gfpgan_dir   = gfpgan_dir
+        self.model_path   = os.path.join(gfpgan_dir, model_path)    # model_path is relative to gfpgan_dir
+        self.bg_upsampler = bg_upsampler
+        self.bg_tile      = bg_tile
+
+    @property
+    def model_exists(self):
+        return os.path.isfile(self.model_path)
+
+gfpgan_config = GFPGANConfig()
+
+# GFPGAN and Real-ESRGAN models are loaded the first time they are needed and
+# kept for the images that follow. A model that goes unused for
+# MODEL_IDLE_SECONDS is dropped to give its memory back. GFPGANer and
+# RealESRGANer keep the image they are working on in the model object, so
+# each model comes with a lock that its enhance() calls must hold.
+MODEL_IDLE_SECONDS = 300
+_models       = {}    # (model, scale, settings..., half precision) -> [model, time last used, lock]
+_models_lock  = threading.RLock()
+_evict_timer  = None
+
+def cached_model(key, loader):
+    '''
+    Returns (model, lock) for the model stored under key, calling loader() to
+    load it the first time. Hold the lock while using the model. Models left
+    idle for MODEL_IDLE_SECONDS are dropped.
+    '''
+    global _evict_timer
+    with _models_lock:
+        evict_idle_models()
+        entry = _models.get(key)
+        if entry is None:
+            entry = _models[key] = [loader(), None, threading.Lock()]
+        entry[1] = time.time()
+        if _evict_timer is not None:
+            _evict_timer.cancel()
+        _evict_timer = threading.Timer(MODEL_IDLE_SECONDS + 1, evict_idle_models)
+        _evict_timer.daemon = True
+        _evict_timer.start()
+        return entry[0], entry[2]
+
+def evict_idle_models(max_idle=None):
+    '''Drops the models unused for max_idle seconds (MODEL_IDLE_SECONDS); 0 drops them all'''
+    max_idle = MODEL_IDLE_SECONDS if max_idle is None else max_idle
+    with _models_lock:
+        now  = time.time()
+        idle = [key for key, (_, last_used, _) in _models.items() if now - last_used >= max_idle]
+        for key in idle:
+            print(f'>> Unloading idle {key[0]} model')
+            del _models[key]
+    if idle and torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
 def run_gfpgan(image, strength, seed, upsampler_scale=4):
     print(f'>> GFPGAN - Restoring Faces for image seed:{seed}')
@@ -20,22 +86,15 @@ def run_gfpgan(image, strength, seed, upsampler_scale=4):
         warnings.filterwarnings('ignore', category=UserWarning)
         
         try:
-            if not gfpgan_model_exists:
-                raise Exception('GFPGAN model not found at path ' + model_path)
-
-            sys.path.append(os.path.abspath(opt.gfpgan_dir))
-            from gfpgan import GFPGANer
-
-            bg_upsampler = _load_gfpgan_bg_upsampler(
-                opt.gfpgan_bg_upsampler, upsampler_scale, opt.gfpgan_bg_tile
-            )
-
-            gfpgan = GFPGANer(
-                model_path=model_path,
-                upscale=upsampler_scale,
-                arch='clean',
-                channel_multiplier=2,
-                bg_upsampler=bg_upsampler,
+            if not gfpgan_config.model_exists:
+                raise Exception('GFPGAN model not found at path ' + gfpgan_config.model_path)
+
+            gfpgan, gfpgan_lock = cached_model(
+                (
+                    'gfpgan', upsampler_scale, gfpgan_config.model_path,
+                    gfpgan_config.bg_upsampler, gfpgan_config.bg_tile, torch.cuda.is_available(),
+                ),
+                lambda: _load_gfpgan(upsampler_scale),
             )
         except Exception:
             import traceback
@@ -48,18 +107,19 @@ def run_gfpgan(image, strength, seed, upsampler_scale=4):
             f'>> WARNING: GFPGAN not initialized.'
         )
         print(
-            f'>> Download https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth to {model_path}, \nor change GFPGAN directory with --gfpgan_dir.'
+            f'>> Download https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth to {gfpgan_config.model_path}, \nor change GFPGAN directory with --gfpgan_dir.'
         )
         return image
 
     image = image.convert('RGB')
 
-    cropped_faces, restored_faces, restored_img = gfpgan.enhance(
-        np.array(image, dtype=np.uint8),
-        has_aligned=False,
-        only_center_face=False,
-        paste_back=True,
-    )
+    with gfpgan_lock:
+        cropped_faces, restored_faces, restored_img = gfpgan.enhance(
+            np.array(image, dtype=np.uint8),
+            has_aligned=False,
+            only_center_face=False,
+            paste_back=True,
+        )
     res = Image.fromarray(restored_img)
 
     if strength < 1.0:
@@ -68,13 +128,28 @@ def run_gfpgan(image, strength, seed, upsampler_scale=4):
             image = image.resize(res.size)
         res = Image.blend(image, res, strength)
 
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gfpgan = None
-
     return res
 
 
+def _load_gfpgan(upsampler_scale):
+    gfpgan_dir = os.path.abspath(gfpgan_config.gfpgan_dir)
+    if gfpgan_dir not in sys.path:
+        sys.path.append(gfpgan_dir)
+    from gfpgan import GFPGANer
+
+    bg_upsampler = _load_gfpgan_bg_upsampler(
+        gfpgan_config.bg_upsampler, upsampler_scale, gfpgan_config.bg_tile
+    )
+
+    return GFPGANer(
+        model_path=gfpgan_config.model_path,
+        upscale=upsampler_scale,
+        arch='clean',
+        channel_multiplier=2,
+        bg_upsampler=bg_upsampler,
+    )
+
+
 def _load_gfpgan_bg_upsampler(bg_upsampler, upsampler_scale, bg_tile=400):
     if bg_upsampler == 'realesrgan':
         if not torch.cuda.is_available(): # CPU or MPS on M1
@@ -137,20 +212,28 @@ def real_esrgan_upscale(image, strength, upsampler_scale, seed):
         warnings.filterwarnings('ignore', category=UserWarning)
 
         try:
-            upsampler = _load_gfpgan_bg_upsampler(
-                opt.gfpgan_bg_upsampler, upsampler_scale, opt.gfpgan_bg_tile
+            upsampler, upsampler_lock = cached_model(
+                (
+                    'realesrgan', upsampler_scale,
+                    gfpgan_config.bg_upsampler, gfpgan_config.bg_tile, torch.cuda.is_available(),
+                ),
+                lambda: _load_gfpgan_bg_upsampler(
+                    gfpgan_config.bg_upsampler, upsampler_scale, gfpgan_config.bg_tile
+                ),
             )
         except Exception:
             import traceback
 
             print('>> Error loading Real-ESRGAN:', file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
+            raise
 
-    output, img_mode = upsampler.enhance(
-        np.array(image, dtype=np.uint8),
-        outscale=upsampler_scale,
-        alpha_upsampler=opt.gfpgan_bg_upsampler,
-    )
+    with upsampler_lock:
+        output, img_mode = upsampler.enhance(
+            np.array(image, dtype=np.uint8),
+            outscale=upsampler_scale,
+            alpha_upsampler=gfpgan_config.bg_upsampler,
+        )
 
     res = Image.fromarray(output)
 
@@ -160,8 +243,4 @@ def real_esrgan_upscale(image, strength, upsampler_scale, seed):
             image = image.resize(res.size)
         res = Image.blend(image, res, strength)
 
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    upsampler = None
-
     return res
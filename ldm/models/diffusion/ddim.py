@@ -5,10 +5,12 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 from ldm.dream.devices import choose_torch_device
+from ldm.models.diffusion.guidance import Guidance
 
 from ldm.modules.diffusionmodules.util import (
     make_ddim_sampling_parameters,
     make_ddim_timesteps,
+    make_ddim_step_coefficients,
     noise_like,
     extract_into_tensor,
 )
@@ -21,6 +23,7 @@ class DDIMSampler(object):
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         self.device   = device or choose_torch_device()
+        self.made_schedule = None   # the arguments of the last make_schedule()
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -35,6 +38,9 @@ class DDIMSampler(object):
         ddim_eta=0.0,
         verbose=True,
     ):
+        schedule = (ddim_num_steps, ddim_discretize, ddim_eta, str(self.model.device))
+        if schedule == self.made_schedule:
+            return
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
             num_ddim_timesteps=ddim_num_steps,
@@ -106,6 +112,20 @@ class DDIMSampler(object):
             sigmas_for_original_sampling_steps,
         )
 
+        # per-step update coefficients, for the ddim steps and the original ones
+        self.step_coefficients = {
+            False: make_ddim_step_coefficients(
+                ddim_alphas, ddim_alphas_prev, ddim_sigmas, self.model.device
+            ),
+            True: make_ddim_step_coefficients(
+                self.alphas_cumprod,
+                self.alphas_cumprod_prev,
+                self.ddim_sigmas_for_original_num_steps,
+                self.model.device,
+            ),
+        }
+        self.made_schedule = schedule
+
     @torch.no_grad()
     def sample(
         self,
@@ -130,6 +150,8 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+        cfg_truncation=0.0,
+        generator=None,
         **kwargs,
     ):
         if conditioning is not None:
@@ -168,6 +190,8 @@ class DDIMSampler(object):
             log_every_t=log_every_t,
             unconditional_guidance_scale=unconditional_guidance_scale,
             unconditional_conditioning=unconditional_conditioning,
+            cfg_truncation=cfg_truncation,
+            generator=generator,
         )
         return samples, intermediates
 
@@ -192,11 +216,13 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        cfg_truncation=0.0,
+        generator=None,
     ):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = noise_like(shape, device, generator=generator)
         else:
             img = x_T
 
@@ -227,6 +253,14 @@ class DDIMSampler(object):
         )
         print(f'Running DDIM Sampling with {total_steps} timesteps')
 
+        guidance = Guidance(
+            cond,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            cfg_truncation,
+        )
+        unguided_from = guidance.first_unguided_step(total_steps)
+
         iterator = tqdm(
             time_range,
             desc='DDIM Sampler',
@@ -241,7 +275,9 @@ class DDIMSampler(object):
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.model.q_sample(
-                    x0, ts
+                    x0,
+                    ts,
+                    noise=noise_like(x0.shape, device, generator=generator).to(x0.dtype),
                 )  # TODO: deterministic forward pass?
                 img = img_orig * mask + (1.0 - mask) * img
 
@@ -256,8 +292,9 @@ class DDIMSampler(object):
                 noise_dropout=noise_dropout,
                 score_corrector=score_corrector,
                 corrector_kwargs=corrector_kwargs,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
+                guidance=guidance,
+                unguided=i >= unguided_from,
+                generator=generator,
             )
             img, pred_x0 = outs
             if callback:
@@ -288,22 +325,17 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        guidance=None,
+        unguided=False,
+        generator=None,
     ):
-        b, *_, device = *x.shape, x.device
+        device = x.device
 
-        if (
-            unconditional_conditioning is None
-            or unconditional_guidance_scale == 1.0
-        ):
-            e_t = self.model.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (
-                e_t - e_t_uncond
+        if guidance is None:
+            guidance = Guidance(
+                c, unconditional_conditioning, unconditional_guidance_scale
             )
+        e_t = guidance(self.model.apply_model, x, t, unguided)
 
         if score_corrector is not None:
             assert self.model.parameterization == 'eps'
@@ -311,46 +343,20 @@ class DDIMSampler(object):
                 self.model, e_t, x, t, c, **corrector_kwargs
             )
 
-        alphas = (
-            self.model.alphas_cumprod
-            if use_original_steps
-            else self.ddim_alphas
-        )
-        alphas_prev = (
-            self.model.alphas_cumprod_prev
-            if use_original_steps
-            else self.ddim_alphas_prev
-        )
-        sqrt_one_minus_alphas = (
-            self.model.sqrt_one_minus_alphas_cumprod
-            if use_original_steps
-            else self.ddim_sqrt_one_minus_alphas
-        )
-        sigmas = (
-            self.model.ddim_sigmas_for_original_num_steps
-            if use_original_steps
-            else self.ddim_sigmas
-        )
-        # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(
-            (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
-        )
+        # select coefficients corresponding to the currently considered timestep
+        coef = self.step_coefficients[use_original_steps]
 
         # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        pred_x0 = x * coef['recip_sqrt_a'][index] - e_t * coef['sqrt_recipm1_a'][index]
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
-        dir_xt = (1.0 - a_prev - sigma_t**2).sqrt() * e_t
-        noise = (
-            sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        )
-        if noise_dropout > 0.0:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        x_prev = pred_x0 * coef['sqrt_a_prev'][index] + e_t * coef['dir_xt'][index]
+        if coef['noisy'][index]:
+            noise = noise_like(x.shape, device, repeat_noise, generator) * temperature
+            if noise_dropout > 0.0:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+            x_prev = x_prev + noise * coef['sigma'][index]
         return x_prev, pred_x0
 
     @torch.no_grad()
@@ -384,6 +390,8 @@ class DDIMSampler(object):
             use_original_steps=False,
             init_latent       = None,
             mask              = None,
+            cfg_truncation    = 0.0,
+            generator         = None,
     ):
 
         timesteps = (
@@ -397,6 +405,14 @@ class DDIMSampler(object):
         total_steps = timesteps.shape[0]
         print(f'Running DDIM Sampling with {total_steps} timesteps')
 
+        guidance = Guidance(
+            cond,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            cfg_truncation,
+        )
+        unguided_from = guidance.first_unguided_step(total_steps)
+
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
         x0    = init_latent
@@ -413,7 +429,9 @@ class DDIMSampler(object):
             if mask is not None:
                 assert x0 is not None
                 xdec_orig = self.model.q_sample(
-                    x0, ts
+                    x0,
+                    ts,
+                    noise=noise_like(x0.shape, x0.device, generator=generator).to(x0.dtype),
                 )  # TODO: deterministic forward pass?
                 x_dec = xdec_orig * mask + (1.0 - mask) * x_dec
 
@@ -423,8 +441,9 @@ class DDIMSampler(object):
                 ts,
                 index=index,
                 use_original_steps=use_original_steps,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
+                guidance=guidance,
+                unguided=i >= unguided_from,
+                generator=generator,
             )
 
             if img_callback:
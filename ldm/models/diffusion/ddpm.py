@@ -14,10 +14,10 @@ import numpy as np
 import pytorch_lightning as pl
 from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange, repeat
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import partial
 from tqdm import tqdm
-from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 import urllib
 
@@ -46,7 +46,6 @@ from ldm.modules.diffusionmodules.util import (
     extract_into_tensor,
     noise_like,
 )
-from ldm.models.diffusion.ddim import DDIMSampler
 
 
 __conditioning_keys__ = {
@@ -56,6 +55,15 @@ __conditioning_keys__ = {
 }
 
 
+def make_grid(*args, **kwargs):
+    # torchvision is only needed for the image logs written during training
+    from torchvision.utils import make_grid
+    return make_grid(*args, **kwargs)
+
+# how many sets of fold/unfold tensors LatentDiffusion keeps for split_input_params
+FOLD_UNFOLD_CACHE_SIZE = 8
+
+
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
     does not change anymore."""
@@ -659,6 +667,9 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        # fold/unfold objects and weighting tensors for split_input_params,
+        # see get_fold_unfold()
+        self.fold_unfold_cache = OrderedDict()
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -883,13 +894,33 @@ class LatentDiffusion(DDPM):
             weighting = weighting * L_weighting
         return weighting
 
-    def get_fold_unfold(
-        self, x, kernel_size, stride, uf=1, df=1
-    ):  # todo load once not every time, shorten code
+    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         """
         :param x: img of size (bs, c, h, w)
         :return: n img crops of size (n, bs, c, kernel_size[0], kernel_size[1])
+
+        The result depends only on the size, device and dtype of x, so it is
+        built once and then taken from fold_unfold_cache, which holds the most
+        recently used FOLD_UNFOLD_CACHE_SIZE of them. The returned tensors are
+        shared and must not be modified in place.
         """
+        weight_params = tuple(
+            self.split_input_params.get(k)
+            for k in ('clip_min_weight', 'clip_max_weight', 'tie_braker',
+                      'clip_min_tie_weight', 'clip_max_tie_weight')
+        )
+        key = (tuple(x.shape[2:]), tuple(kernel_size), tuple(stride), uf, df,
+               x.device, x.dtype, weight_params)
+        cache = self.fold_unfold_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        cache[key] = self._make_fold_unfold(x, kernel_size, stride, uf, df)
+        while len(cache) > FOLD_UNFOLD_CACHE_SIZE:
+            cache.popitem(last=False)
+        return cache[key]
+
+    def _make_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         bs, nc, h, w = x.shape
 
         # number of crops in image
@@ -1867,6 +1898,7 @@ class LatentDiffusion(DDPM):
     def sample_log(self, cond, batch_size, ddim, ddim_steps, **kwargs):
 
         if ddim:
+            from ldm.models.diffusion.ddim import DDIMSampler
             ddim_sampler = DDIMSampler(self)
             shape = (self.channels, self.image_size, self.image_size)
             samples, intermediates = ddim_sampler.sample(
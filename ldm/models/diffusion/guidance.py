@@ -0,0 +1,46 @@
+"""classifier-free guidance shared by the DDIM, PLMS and k-diffusion samplers"""
+import math
+import torch
+
+
+class Guidance(object):
+    """
+    Mixes the model's unconditional and conditional predictions:
+        uncond + (cond - uncond) * scale
+
+    Both predictions come from one call on a doubled batch. The doubled
+    conditioning never changes during sampling, so it is concatenated once,
+    here, rather than at every step.
+
+    With truncation > 0, the last truncation fraction of the steps are run on
+    the conditional branch alone, which halves the UNet's work for them. Late
+    steps only refine detail, and guidance matters little by then.
+    """
+
+    def __init__(self, cond, uncond=None, scale=1.0, truncation=0.0):
+        assert (
+            0.0 <= truncation <= 1.0
+        ), '--cfg_truncation must be in [0.0, 1.0]'
+        self.cond = cond
+        self.scale = scale
+        self.truncation = truncation
+        self.guided = uncond is not None and scale != 1.0
+        self.cond_in = torch.cat([uncond, cond]) if self.guided else None
+
+    def first_unguided_step(self, total_steps):
+        """index of the first step to skip the unconditional branch for; total_steps if none are"""
+        if not self.guided:
+            return 0
+        return total_steps - int(math.floor(total_steps * self.truncation))
+
+    def __call__(self, denoise, x, t, unguided=False):
+        """
+        denoise(x, t, cond) is the model. With unguided, or no guidance to
+        apply, it is called on the conditioning alone.
+        """
+        if not self.guided or unguided:
+            return denoise(x, t, self.cond)
+        x_in = torch.cat([x] * 2)
+        t_in = torch.cat([t] * 2)
+        e_uncond, e_cond = denoise(x_in, t_in, self.cond_in).chunk(2)
+        return e_uncond + (e_cond - e_uncond) * self.scale
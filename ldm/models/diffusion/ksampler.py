@@ -1,20 +1,60 @@
 """wrapper around part of Katherine Crowson's k-diffusion library, making it call compatible with other Samplers"""
+import inspect
+import itertools
+import types
 import k_diffusion as K
 import torch
 import torch.nn as nn
 from ldm.dream.devices import choose_torch_device
+from ldm.models.diffusion.guidance import Guidance
+from ldm.modules.diffusionmodules.util import noise_like
+
+class NoiseFromGenerators(object):
+    '''
+    Stands in for the torch module in the globals of an older k-diffusion
+    sampler, which draws its noise with torch.randn_like(), so that the noise
+    comes from noise(x) instead of the global RNG. Everything else is torch's.
+    '''
+    def __init__(self, noise):
+        self.noise = noise
+
+    def randn_like(self, x, *args, **kwargs):
+        return self.noise(x)
+
+    def __getattr__(self, name):
+        return getattr(torch, name)
+
+
+# model evaluations per step of the k-diffusion samplers that make more than
+# one; each of them makes only one on a last step down to sigma 0
+EVALUATIONS_PER_STEP = {
+    'heun'            : 2,
+    'dpm_2'           : 2,
+    'dpm_2_ancestral' : 2,
+}
+
 
 class CFGDenoiser(nn.Module):
     def __init__(self, model):
         super().__init__()
         self.inner_model = model
 
-    def forward(self, x, sigma, uncond, cond, cond_scale):
-        x_in = torch.cat([x] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        return uncond + (cond - uncond) * cond_scale
+    # k-diffusion samplers don't say which step they are on, so each call
+    # takes its number from evaluations, and guidance is dropped from call
+    # unguided_from on, the first of the truncated steps. Sigma can't say
+    # either: heun and dpm_2 evaluate a step at sigmas below its own, and
+    # reading it would wait on the device every call.
+    # Where mask is 1, the prediction is replaced by init_latent, which keeps
+    # that part of the image as it was.
+    def forward(self, x, sigma, guidance, evaluations=None, unguided_from=None, mask=None, init_latent=None):
+        unguided = unguided_from is not None and next(evaluations) >= unguided_from
+        denoised = guidance(self.denoise, x, sigma, unguided)
+        if mask is not None:
+            denoised = init_latent * mask + (1.0 - mask) * denoised
+        return denoised
+
+    def denoise(self, x, sigma, cond):
+        return self.inner_model(x, sigma, cond=cond)
 
 
 class KSampler(object):
@@ -23,15 +63,20 @@ class KSampler(object):
         self.model = K.external.CompVisDenoiser(model)
         self.schedule = schedule
         self.device   = device or choose_torch_device()
+        self.model_wrap_cfg = CFGDenoiser(self.model)
+        self.sigmas   = None
 
-        def forward(self, x, sigma, uncond, cond, cond_scale):
-            x_in = torch.cat([x] * 2)
-            sigma_in = torch.cat([sigma] * 2)
-            cond_in = torch.cat([uncond, cond])
-            uncond, cond = self.inner_model(
-                x_in, sigma_in, cond=cond_in
-            ).chunk(2)
-            return uncond + (cond - uncond) * cond_scale
+    def make_schedule(
+        self,
+        ddim_num_steps,
+        ddim_discretize='uniform',
+        ddim_eta=0.0,
+        verbose=False,
+    ):
+        # the arguments are those of DDIMSampler.make_schedule(); only the
+        # step count matters here
+        if self.sigmas is None or len(self.sigmas) != ddim_num_steps + 1:
+            self.sigmas = self.model.get_sigmas(ddim_num_steps)
 
     # most of these arguments are ignored and are only present for compatibility with
     # other samples
@@ -59,30 +104,141 @@ class KSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+        cfg_truncation=0.0,
+        generator=None,
         **kwargs,
     ):
-        def route_callback(k_callback_values):
-            if img_callback is not None:
-                img_callback(k_callback_values['x'], k_callback_values['i'])
-
-        sigmas = self.model.get_sigmas(S)
+        self.make_schedule(S)
+        sigmas = self.sigmas
         if x_T is not None:
             x = x_T * sigmas[0]
         else:
             x = (
-                torch.randn([batch_size, *shape], device=self.device)
+                noise_like([batch_size, *shape], self.device, generator=generator)
                 * sigmas[0]
             )   # for GPU draw
-        model_wrap_cfg = CFGDenoiser(self.model)
-        extra_args = {
-            'cond': conditioning,
-            'uncond': unconditional_conditioning,
-            'cond_scale': unconditional_guidance_scale,
-        }
         return (
-            K.sampling.__dict__[f'sample_{self.schedule}'](
-                model_wrap_cfg, x, sigmas, extra_args=extra_args,
-                callback=route_callback
+            self._sample(
+                x,
+                sigmas,
+                conditioning,
+                img_callback,
+                unconditional_guidance_scale,
+                unconditional_conditioning,
+                cfg_truncation,
+                generator = generator,
             ),
             None,
         )
+
+    # img2img and inpaint: noise x0 to the sigma that sampling t steps from
+    # the end of the schedule starts at. t holds the step count for each row.
+    @torch.no_grad()
+    def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
+        if noise is None:
+            noise = torch.randn_like(x0)
+        steps = len(self.sigmas) - 1
+        sigma = self.sigmas[steps - t.to(self.sigmas.device).long()]
+        return x0 + noise * sigma.to(x0.device).reshape(-1, *([1] * (x0.ndim - 1)))
+
+    # samples the last t_start steps of the schedule from x_latent, which
+    # stochastic_encode() noised. Where mask is 1, init_latent is kept.
+    @torch.no_grad()
+    def decode(
+            self,
+            x_latent,
+            cond,
+            t_start,
+            img_callback=None,
+            unconditional_guidance_scale=1.0,
+            unconditional_conditioning=None,
+            use_original_steps=False,
+            init_latent       = None,
+            mask              = None,
+            cfg_truncation    = 0.0,
+            generator         = None,
+    ):
+        steps  = len(self.sigmas) - 1
+        sigmas = self.sigmas[steps - t_start:]
+        return self._sample(
+            x_latent,
+            sigmas,
+            cond,
+            img_callback,
+            unconditional_guidance_scale,
+            unconditional_conditioning,
+            cfg_truncation,
+            mask        = mask,
+            init_latent = init_latent,
+            generator   = generator,
+        )
+
+    def _sample(
+            self,
+            x,
+            sigmas,
+            cond,
+            img_callback,
+            unconditional_guidance_scale,
+            unconditional_conditioning,
+            cfg_truncation,
+            mask        = None,
+            init_latent = None,
+            generator   = None,
+    ):
+        def route_callback(k_callback_values):
+            if img_callback is not None:
+                img_callback(k_callback_values['x'], k_callback_values['i'])
+
+        steps = len(sigmas) - 1
+        guidance = Guidance(
+            cond,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            cfg_truncation,
+        )
+        unguided_from = guidance.first_unguided_step(steps)
+        extra_args = {
+            'guidance'      : guidance,
+            'evaluations'   : itertools.count(),
+            'unguided_from' : (
+                unguided_from * EVALUATIONS_PER_STEP.get(self.schedule, 1)
+                if unguided_from < steps else None
+            ),
+        }
+        if mask is not None:
+            assert init_latent is not None
+            extra_args['mask']        = mask
+            extra_args['init_latent'] = init_latent
+        sample = K.sampling.__dict__[f'sample_{self.schedule}']
+        if generator is None:
+            return sample(
+                self.model_wrap_cfg, x, sigmas, extra_args=extra_args,
+                callback=route_callback,
+            )
+        # generator may be one per row of x
+        noise = lambda like: noise_like(like.shape, like.device, generator=generator).to(like.dtype)
+        if 'noise_sampler' in inspect.signature(sample).parameters:
+            return sample(
+                self.model_wrap_cfg, x, sigmas, extra_args=extra_args,
+                callback=route_callback,
+                noise_sampler=lambda sigma, sigma_next: noise(x),
+            )
+        return self._sample_with_noise(sample, noise)(
+            self.model_wrap_cfg, x, sigmas, extra_args=extra_args,
+            callback=route_callback,
+        )
+
+    # Older k-diffusion releases, like the one in environment.yaml, have no
+    # noise_sampler argument. This returns a copy of their sample function
+    # whose torch.randn_like() calls draw from noise() instead, in the same
+    # order, so a seed gives the image it gave when the global RNG was seeded
+    # with it. The copy has globals of its own, so nothing global is changed.
+    def _sample_with_noise(self, sample, noise):
+        inner   = inspect.unwrap(sample)
+        globals = dict(inner.__globals__, torch=NoiseFromGenerators(noise))
+        copy    = types.FunctionType(
+            inner.__code__, globals, inner.__name__, inner.__defaults__, inner.__closure__
+        )
+        copy.__kwdefaults__ = inner.__kwdefaults__
+        return torch.no_grad()(copy)
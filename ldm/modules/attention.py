@@ -34,6 +34,168 @@ def init_(tensor):
     return tensor
 
 
+# attention backends
+#
+# Each backend computes softmax(q @ k^T * scale) @ v for q of shape
+# (batch, queries, dim) and k, v of shape (batch, keys, dim), where batch is
+# the images times the heads, given as heads. They differ in
+# how much of the (batch, queries, keys) score matrix exists at once:
+#   einsum -- all of it
+#   sliced -- q_chunk rows of it at a time
+#   flash  -- q_chunk x kv_chunk blocks at a time, combined with an online
+#             softmax, so memory doesn't grow with the number of keys
+#   sdp    -- torch's fused scaled_dot_product_attention, where available.
+#             Its flash and memory-efficient kernels need (images, heads,
+#             tokens, dim) inputs and a small dim; otherwise it falls back to
+#             building all of the score matrix, like einsum
+# plan_attention() picks a backend and chunk sizes from the shapes and the
+# attention memory budget, and on mps keeps every matmul under the number of
+# score elements it can take.
+
+ATTENTION_BACKENDS = {}
+MIN_QUERY_CHUNK    = 128    # below this, slicing queries is slower than flash
+SCORE_OVERHEAD     = 3      # scores, probabilities and temporaries per score element
+MPS_MAX_SCORES     = 2**30  # score elements mps can take in one matmul; 2**31 throws an error
+
+_memory_budget  = None      # bytes; None means measure each device once
+_device_budgets = {}
+
+
+def register_attention_backend(name):
+    def register(fn):
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+def set_attention_memory_budget(budget_bytes):
+    """Caps the memory plan_attention() lets a score matrix take. None measures free memory instead"""
+    global _memory_budget
+    _memory_budget = budget_bytes
+
+
+def attention_memory_budget(device):
+    if _memory_budget is not None:
+        return _memory_budget
+    key = str(device)
+    if key not in _device_budgets:
+        if device.type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(device)
+            free   += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        else:
+            free = psutil.virtual_memory().available
+        _device_budgets[key] = free // 2
+    return _device_budgets[key]
+
+
+def plan_attention(q, k, backend=None, budget=None):
+    """
+    Returns (backend, q_chunk, kv_chunk) for attending q to k. With backend
+    given, only the chunk sizes are planned. The plan depends only on the
+    shapes, dtype and budget.
+    """
+    batch, n_q, _ = q.shape
+    n_k      = k.shape[1]
+    budget   = budget or attention_memory_budget(q.device)
+    per_row  = batch * n_k * q.element_size() * SCORE_OVERHEAD
+    max_rows = budget // per_row
+    if q.device.type == 'mps':
+        # however much memory there is, mps can't take more scores than this at once
+        max_rows = min(max_rows, MPS_MAX_SCORES // (batch * n_k))
+
+    if backend in (None, 'auto'):
+        # sdp may build the whole score matrix too, so it gets the same test as einsum
+        if n_q <= max_rows:
+            backend = 'sdp' if 'sdp' in ATTENTION_BACKENDS and q.device.type == 'cuda' else 'einsum'
+        elif max_rows >= MIN_QUERY_CHUNK:
+            backend = 'sliced'
+        else:
+            backend = 'flash'
+    assert backend in ATTENTION_BACKENDS, f'unknown attention backend "{backend}"; choose from {", ".join(ATTENTION_BACKENDS)}'
+
+    if backend == 'sliced':
+        return backend, int(max(1, min(n_q, max_rows))), n_k
+    if backend == 'flash':
+        q_chunk  = min(n_q, 1024)
+        kv_chunk = budget // (batch * q_chunk * 4 * SCORE_OVERHEAD)   # accumulated in float32
+        if q.device.type == 'mps':
+            kv_chunk = min(kv_chunk, MPS_MAX_SCORES // (batch * q_chunk))
+        return backend, q_chunk, int(max(1, min(n_k, kv_chunk)))
+    return backend, n_q, n_k
+
+
+def attention(q, k, v, scale, backend=None, budget=None, heads=1):
+    """softmax(q k^T * scale) v using the given backend, or the one plan_attention() picks"""
+    backend, q_chunk, kv_chunk = plan_attention(q, k, backend, budget)
+    return ATTENTION_BACKENDS[backend](q, k, v, scale, q_chunk, kv_chunk, heads)
+
+
+@register_attention_backend('einsum')
+def einsum_attention(q, k, v, scale, q_chunk=None, kv_chunk=None, heads=1):
+    s1 = einsum('b i d, b j d -> b i j', q, k) * scale
+    s2 = s1.softmax(dim=-1, dtype=q.dtype)
+    del s1
+    return einsum('b i j, b j d -> b i d', s2, v)
+
+
+@register_attention_backend('sliced')
+def sliced_attention(q, k, v, scale, q_chunk, kv_chunk=None, heads=1):
+    r1 = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    for i in range(0, q.shape[1], q_chunk):
+        end = i + q_chunk
+        s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * scale
+        s2 = s1.softmax(dim=-1, dtype=q.dtype)
+        del s1
+        r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
+        del s2
+    return r1
+
+
+@register_attention_backend('flash')
+def flash_attention(q, k, v, scale, q_chunk, kv_chunk, heads=1):
+    r1 = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    for i in range(0, q.shape[1], q_chunk):
+        qi    = q[:, i:i + q_chunk] * scale
+        top   = torch.full((qi.shape[0], qi.shape[1], 1), -math.inf, device=q.device)
+        total = torch.zeros_like(top)
+        acc   = torch.zeros(qi.shape[0], qi.shape[1], v.shape[2], device=q.device)
+        for j in range(0, k.shape[1], kv_chunk):
+            s = einsum('b i d, b j d -> b i j', qi, k[:, j:j + kv_chunk]).float()
+            new_top = torch.maximum(top, s.amax(dim=-1, keepdim=True))
+            p       = torch.exp(s - new_top)
+            del s
+            rescale = torch.exp(top - new_top)
+            total   = total * rescale + p.sum(dim=-1, keepdim=True)
+            acc     = acc * rescale + einsum('b i j, b j d -> b i d', p.to(v.dtype), v[:, j:j + kv_chunk]).float()
+            top     = new_top
+            del p
+        r1[:, i:i + q_chunk] = (acc / total).to(q.dtype)
+    return r1
+
+
+if hasattr(F, 'scaled_dot_product_attention'):
+    @register_attention_backend('sdp')
+    def sdp_attention(q, k, v, scale, q_chunk=None, kv_chunk=None, heads=1):
+        # the fused kernels only run on 4-D inputs; splitting the batch
+        # dimension into images and heads is always a view
+        q, k, v = (t.unflatten(0, (-1, heads)) for t in (q, k, v))
+        # older versions of the function take no scale argument
+        r1 = F.scaled_dot_product_attention(q * (scale * q.shape[-1] ** 0.5), k, v)
+        return r1.flatten(0, 1)
+
+
+def set_attention_backend(model, backend):
+    """
+    Makes every attention module in model (CrossAttention, and the autoencoder's
+    AttnBlock) use backend, or plan per call with None or 'auto'
+    """
+    assert backend in (None, 'auto') or backend in ATTENTION_BACKENDS, \
+        f'unknown attention backend "{backend}"; choose from auto, {", ".join(ATTENTION_BACKENDS)}'
+    for module in model.modules():
+        if hasattr(module, 'attention_backend'):
+            module.attention_backend = None if backend == 'auto' else backend
+
+
 # feedforward
 class GEGLU(nn.Module):
     def __init__(self, dim_in, dim_out):
@@ -168,110 +330,21 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
-        if not torch.cuda.is_available():
-            mem_av = psutil.virtual_memory().available / (1024**3)
-            if mem_av > 32:
-                self.einsum_op = self.einsum_op_v1
-            elif mem_av > 12:
-                self.einsum_op = self.einsum_op_v2
-            else:
-                self.einsum_op = self.einsum_op_v3   
-            del mem_av 
-        else:
-            self.einsum_op = self.einsum_op_v4
-
-    # mps 64-128 GB
-    def einsum_op_v1(self, q, k, v, r1):
-        if q.shape[1] <= 4096: # for 512x512: the max q.shape[1] is 4096
-            s1 = einsum('b i d, b j d -> b i j', q, k) * self.scale # aggressive/faster: operation in one go
-            s2 = s1.softmax(dim=-1, dtype=q.dtype)
-            del s1
-            r1 = einsum('b i j, b j d -> b i d', s2, v)
-            del s2
-        else:
-            # q.shape[0] * q.shape[1] * slice_size >= 2**31 throws err
-            # needs around half of that slice_size to not generate noise
-            slice_size = math.floor(2**30 / (q.shape[0] * q.shape[1]))
-            for i in range(0, q.shape[1], slice_size):
-                end = i + slice_size
-                s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-                s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-                del s1  
-                r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-                del s2
-        return r1
-
-    # mps 16-32 GB (can be optimized)
-    def einsum_op_v2(self, q, k, v, r1):
-        slice_size = math.floor(2**30 / (q.shape[0] * q.shape[1]))
-        for i in range(0, q.shape[1], slice_size): # conservative/less mem: operation in steps
-            end = i + slice_size
-            s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-            s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-            del s1  
-            r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-            del s2
-        return r1
-
-    # mps 8 GB
-    def einsum_op_v3(self, q, k, v, r1):
-        slice_size = 1
-        for i in range(0, q.shape[0], slice_size): # iterate over q.shape[0]
-            end = min(q.shape[0], i + slice_size)
-            s1 = einsum('b i d, b j d -> b i j', q[i:end], k[i:end]) # adapted einsum for mem
-            s1 *= self.scale
-            s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-            del s1
-            r1[i:end] = einsum('b i j, b j d -> b i d', s2, v[i:end]) # adapted einsum for mem
-            del s2
-        return r1
-
-    # cuda
-    def einsum_op_v4(self, q, k, v, r1):
-        stats = torch.cuda.memory_stats(q.device)
-        mem_active = stats['active_bytes.all.current']
-        mem_reserved = stats['reserved_bytes.all.current']
-        mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-        mem_free_torch = mem_reserved - mem_active
-        mem_free_total = mem_free_cuda + mem_free_torch
-
-        gb = 1024 ** 3
-        tensor_size = q.shape[0] * q.shape[1] * k.shape[1] * 4
-        mem_required = tensor_size * 2.5
-        steps = 1
-
-        if mem_required > mem_free_total:
-            steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-
-        if steps > 64:
-            max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
-            raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
-                            f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
-        
-        slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]  
-        for i in range(0, q.shape[1], slice_size):
-            end = min(q.shape[1], i + slice_size)
-            s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-            s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-            del s1
-            r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-            del s2 
-        return r1
-
-    def forward(self, x, context=None, mask=None):
+        # None lets plan_attention() choose on each call; see set_attention_backend()
+        self.attention_backend = None
+
+    def forward(self, x, context=None, mask=None, backend=None):
         h = self.heads
 
         q_in = self.to_q(x)
         context = default(context, x)
         k_in = self.to_k(context)
         v_in = self.to_v(context)
-        device_type = 'mps' if x.device.type == 'mps' else 'cuda'
         del context, x
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q_in, k_in, v_in))
         del q_in, k_in, v_in
-        r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
-        r1 = self.einsum_op(q, k, v, r1)
+        r1 = attention(q, k, v, self.scale, backend or self.attention_backend, heads=h)
         del q, k, v
 
         r2 = rearrange(r1, '(b h) n d -> b n (h d)', h=h)
@@ -7,9 +7,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
-
-import psutil
+from ldm.modules.attention import LinearAttention, attention
 
 def get_timestep_embedding(timesteps, embedding_dim):
     """
@@ -186,72 +184,33 @@ class AttnBlock(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        # None lets plan_attention() choose; see set_attention_backend()
+        self.attention_backend = None
 
-
-    def forward(self, x):
+    def forward(self, x, backend=None):
         h_ = x
         h_ = self.norm(h_)
         q1 = self.q(h_)
         k1 = self.k(h_)
-        v = self.v(h_)
+        v1 = self.v(h_)
 
         # compute attention
         b, c, h, w = q1.shape
 
-        q2 = q1.reshape(b, c, h*w)
-        del q1
-
-        q = q2.permute(0, 2, 1)   # b,hw,c
-        del q2
-
-        k = k1.reshape(b, c, h*w) # b,c,hw
-        del k1
+        # b,hw,c for each of them
+        q = q1.reshape(b, c, h*w).permute(0, 2, 1)
+        k = k1.reshape(b, c, h*w).permute(0, 2, 1)
+        v = v1.reshape(b, c, h*w).permute(0, 2, 1)
+        del q1, k1, v1, h_
 
-        h_ = torch.zeros_like(k, device=q.device)
+        # The chunk sizes depend only on the shapes and the attention memory
+        # budget, so a large latent is decoded in query (or query and key)
+        # blocks instead of building the whole hw x hw matrix.
+        h1 = attention(q, k, v, int(c)**(-0.5), backend or self.attention_backend)
+        del q, k, v
 
-        device_type = 'mps' if q.device.type == 'mps' else 'cuda'
-        if device_type == 'cuda':
-            stats = torch.cuda.memory_stats(q.device)
-            mem_active = stats['active_bytes.all.current']
-            mem_reserved = stats['reserved_bytes.all.current']
-            mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-            mem_free_torch = mem_reserved - mem_active
-            mem_free_total = mem_free_cuda + mem_free_torch
-
-            tensor_size = q.shape[0] * q.shape[1] * k.shape[2] * 4
-            mem_required = tensor_size * 2.5
-            steps = 1
-
-            if mem_required > mem_free_total:
-                steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-            
-            slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
-
-        else:
-            if psutil.virtual_memory().available / (1024**3) < 12:
-                slice_size = 1
-            else:
-                slice_size = min(q.shape[1], math.floor(2**30 / (q.shape[0] * q.shape[1])))
-        
-        for i in range(0, q.shape[1], slice_size):
-            end = i + slice_size
-
-            w1 = torch.bmm(q[:, i:end], k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-            w2 = w1 * (int(c)**(-0.5))
-            del w1
-            w3 = torch.nn.functional.softmax(w2, dim=2)
-            del w2
-
-            # attend to values
-            v1 = v.reshape(b, c, h*w)
-            w4 = w3.permute(0, 2, 1)   # b,hw,hw (first hw of k, second of q)
-            del w3
-
-            h_[:, :, i:end] = torch.bmm(v1, w4)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-            del v1, w4
-
-        h2 = h_.reshape(b, c, h, w)
-        del h_
+        h2 = h1.permute(0, 2, 1).reshape(b, c, h, w)
+        del h1
 
         h3 = self.proj_out(h2)
         del h2
@@ -113,6 +113,41 @@ def make_ddim_sampling_parameters(
     return sigmas, alphas, alphas_prev
 
 
+def make_ddim_step_coefficients(alphas, alphas_prev, sigmas, device):
+    """
+    Precompute the per-step coefficients of the DDIM update
+        pred_x0 = x * recip_sqrt_a - e_t * sqrt_recipm1_a
+        x_prev  = pred_x0 * sqrt_a_prev + e_t * dir_xt + sigma * noise
+    as (steps, 1, 1, 1) float32 tensors on device, so that indexing a step
+    gives a view that broadcasts over any batch size. 'noisy' is a CPU list
+    telling which steps have a non-zero sigma and so need a noise draw.
+    """
+    to_torch = (
+        lambda a: torch.as_tensor(a)
+        .detach()
+        .to(device='cpu', dtype=torch.float64)
+        .reshape(-1, 1, 1, 1)
+    )
+    alphas, alphas_prev, sigmas = (
+        to_torch(alphas),
+        to_torch(alphas_prev),
+        to_torch(sigmas),
+    )
+    coefficients = {
+        'recip_sqrt_a': 1.0 / alphas.sqrt(),
+        'sqrt_recipm1_a': (1.0 / alphas - 1.0).sqrt(),
+        'sqrt_a_prev': alphas_prev.sqrt(),
+        'dir_xt': (1.0 - alphas_prev - sigmas**2).sqrt(),
+        'sigma': sigmas,
+    }
+    coefficients = {
+        name: c.to(dtype=torch.float32, device=device)
+        for name, c in coefficients.items()
+    }
+    coefficients['noisy'] = (sigmas.reshape(-1) != 0).tolist()
+    return coefficients
+
+
 def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     """
     Create a beta schedule that discretizes the given alpha_t_bar function,
@@ -310,9 +345,21 @@ class HybridConditioner(nn.Module):
         return {'c_concat': [c_concat], 'c_crossattn': [c_crossattn]}
 
 
-def noise_like(shape, device, repeat=False):
-    repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(
-        shape[0], *((1,) * (len(shape) - 1))
-    )
-    noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
+def noise_like(shape, device, repeat=False, generator=None):
+    # generator may be a list of them, one per row, so that each row gets the
+    # noise it would get in a batch of its own
+    if isinstance(generator, (list, tuple)):
+        if repeat or len(generator) == 1:
+            generator = generator[0]
+        else:
+            assert len(generator) == shape[0], f'{len(generator)} generators for {shape[0]} rows of noise'
+            return torch.cat([
+                noise_like((1, *shape[1:]), device, generator=g) for g in generator
+            ])
+    # with a generator, the noise is drawn on the generator's device
+    draw_on = generator.device if generator is not None else device
+    repeat_noise = lambda: torch.randn(
+        (1, *shape[1:]), device=draw_on, generator=generator
+    ).repeat(shape[0], *((1,) * (len(shape) - 1)))
+    noise = lambda: torch.randn(shape, device=draw_on, generator=generator)
+    return (repeat_noise() if repeat else noise()).to(device)
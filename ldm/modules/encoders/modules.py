@@ -1,10 +1,8 @@
 import torch
 import torch.nn as nn
 from functools import partial
-import clip
 from einops import rearrange, repeat
 from transformers import CLIPTokenizer, CLIPTextModel
-import kornia
 from ldm.dream.devices import choose_torch_device
 
 from ldm.modules.x_transformer import (
@@ -469,6 +467,7 @@ class FrozenCLIPTextEmbedder(nn.Module):
         normalize=True,
     ):
         super().__init__()
+        import clip
         self.model, _ = clip.load(version, jit=False, device=device)
         self.device = device
         self.max_length = max_length
@@ -481,6 +480,7 @@ class FrozenCLIPTextEmbedder(nn.Module):
             param.requires_grad = False
 
     def forward(self, text):
+        import clip
         tokens = clip.tokenize(text).to(self.device)
         z = self.model.encode_text(tokens)
         if self.normalize:
@@ -508,6 +508,7 @@ class FrozenClipImageEmbedder(nn.Module):
         antialias=False,
     ):
         super().__init__()
+        import clip
         self.model, _ = clip.load(name=model, device=device, jit=jit)
 
         self.antialias = antialias
@@ -524,6 +525,7 @@ class FrozenClipImageEmbedder(nn.Module):
         )
 
     def preprocess(self, x):
+        import kornia
         # normalize to [0,1]
         x = kornia.geometry.resize(
             x,
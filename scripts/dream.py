@@ -9,9 +9,14 @@ import sys
 import copy
 import warnings
 import time
+from ldm.dream.startup_profile import startup_profile
+if '--profile_startup' in sys.argv:    # started before the imports below, so that they are timed too
+    startup_profile.start()
 import ldm.dream.readline
-from ldm.dream.pngwriter import PngWriter, PromptFormatter
+from ldm.dream.pngwriter import PngWriter, PromptFormatter, writer_pool
 from ldm.dream.server import DreamServer, ThreadingDreamServer
+from ldm.dream.scheduler import RequestScheduler
+from ldm.dream.gallery import GalleryStore
 from ldm.dream.image_util import make_grid
 from omegaconf import OmegaConf
 
@@ -47,6 +52,7 @@ def main():
     sys.path.append('.')
     from pytorch_lightning import logging
     from ldm.generate import Generate
+    from ldm.gfpgan.gfpgan_tools import gfpgan_config
 
     # these two lines prevent a horrible warning message from appearing
     # when the frozen CLIP tokenizer is imported
@@ -66,11 +72,35 @@ def main():
         full_precision=opt.full_precision,
         config=config,
         grid=opt.grid,
+        batch_size=opt.batch_size,
         # this is solely for recreating the prompt
         seamless=opt.seamless,
         embedding_path=opt.embedding_path,
         device_type=opt.device,
         ignore_ctrl_c=opt.infile is None,
+        model_name=opt.model,
+        models_config=opt.config,
+        model_cache_gb=opt.model_cache_gb,
+        park_models=not opt.keep_models_on_device,
+        mmap_weights=opt.mmap_weights,
+        inference_snapshots=opt.inference_snapshot,
+        attention_backend=opt.attention,
+        attention_memory_gb=opt.attention_memory_gb,
+        vae_tile_size=opt.vae_tile_size,
+        vae_tile_overlap=opt.vae_tile_overlap,
+        cfg_truncation=opt.cfg_truncation,
+        postprocess_workers=opt.postprocess_workers,
+    )
+
+    # images are encoded and written in the background
+    writer_pool.configure(workers=opt.write_threads, compress_level=opt.png_compression)
+
+    # where -G and -U find their models; they are loaded the first time they're used
+    gfpgan_config.configure(
+        gfpgan_dir   = opt.gfpgan_dir,
+        model_path   = opt.gfpgan_model_path,
+        bg_upsampler = opt.gfpgan_bg_upsampler,
+        bg_tile      = opt.gfpgan_bg_tile,
     )
 
     # make sure the output directory exists
@@ -98,7 +128,10 @@ def main():
         print(">> changed to seamless tiling mode")
 
     # preload the model
-    t2i.load_model()
+    with startup_profile.timed('step', 'load_model'):
+        t2i.load_model()
+    if opt.profile_startup:
+        startup_profile.report()
 
     if not infile:
         print(
@@ -107,12 +140,12 @@ def main():
 
     cmd_parser = create_cmd_parser()
     if opt.web:
-        dream_server_loop(t2i, opt.host, opt.port, opt.outdir)
+        dream_server_loop(t2i, opt.host, opt.port, opt.outdir, opt.intermediate_format, opt.shard_size)
     else:
-        main_loop(t2i, opt.outdir, opt.prompt_as_dir, cmd_parser, infile)
+        main_loop(t2i, opt.outdir, opt.prompt_as_dir, cmd_parser, infile, opt.shard_size)
 
 
-def main_loop(t2i, outdir, prompt_as_dir, parser, infile):
+def main_loop(t2i, outdir, prompt_as_dir, parser, infile, shard_size=None):
     """prompt/read/execute loop"""
     done = False
     path_filter = re.compile(r'[<>:"/\\|?*]')
@@ -157,6 +190,24 @@ def main_loop(t2i, outdir, prompt_as_dir, parser, infile):
             done = True
             break
 
+        if elements[0] == '!switch':
+            if len(elements) != 2:
+                print('usage: !switch <model name from models.yaml>')
+                continue
+            try:
+                t2i.switch_model(elements[1])
+            except (AssertionError, OSError, SystemExit) as e:
+                print(e)
+            continue
+
+        if elements[0] == '!models':
+            models = OmegaConf.load(t2i.models_config)
+            loaded = t2i.model_cache.stats()['models']
+            for name in models:
+                state = 'active' if name == t2i.model_name else 'loaded' if name in loaded else ''
+                print(f'{name:30} {state}')
+            continue
+
         if elements[0].startswith(
             '!dream'
         ):   # in case a stored prompt still contains the !dream command
@@ -255,7 +306,7 @@ def main_loop(t2i, outdir, prompt_as_dir, parser, infile):
         # Here is where the images are actually generated!
         last_results = []
         try:
-            file_writer = PngWriter(current_outdir)
+            file_writer = PngWriter(current_outdir, shard_size=shard_size)
             prefix = file_writer.unique_prefix()
             results = []  # list of filename, prompt pairs
             grid_images = dict()  # seed -> Image, only used if `do_grid`
@@ -289,8 +340,9 @@ def main_loop(t2i, outdir, prompt_as_dir, parser, infile):
                         normalized_prompt = PromptFormatter(
                             t2i, opt).normalize_prompt()
                         metadata_prompt = f'{normalized_prompt} -S{seed}'
-                    path = file_writer.save_image_and_prompt_to_png(
-                        image, metadata_prompt, filename)
+                    # written in the background; flushed once the command is done
+                    file_writer.queue_image_and_prompt(image, metadata_prompt, filename)
+                    path = file_writer.path_for(filename)
                     if (not upscaled) or opt.save_original:
                         # only append to results if we didn't overwrite an earlier output
                         results.append([path, metadata_prompt])
@@ -312,6 +364,14 @@ def main_loop(t2i, outdir, prompt_as_dir, parser, infile):
                 )
                 results = [[path, metadata_prompt]]
 
+            # make sure every image is on disk; whatever a write raised was
+            # printed with the path when it failed, and isn't worth quitting over
+            try:
+                writer_pool.flush()
+            except Exception as e:
+                print(f'** some images were not written: {e}')
+                continue
+
         except AssertionError as e:
             print(e)
             continue
@@ -341,7 +401,7 @@ def get_next_command(infile=None) -> str:  # command string
     return command
 
 
-def dream_server_loop(t2i, host, port, outdir):
+def dream_server_loop(t2i, host, port, outdir, intermediate_format='png', shard_size=None):
     print('\n* --web was specified, starting web server...')
     # Change working directory to the stable-diffusion directory
     os.chdir(
@@ -351,6 +411,19 @@ def dream_server_loop(t2i, host, port, outdir):
     # Start server
     DreamServer.model = t2i
     DreamServer.outdir = outdir
+    DreamServer.intermediate_format = intermediate_format
+    DreamServer.shard_size = shard_size
+    DreamServer.gallery = GalleryStore(
+        os.path.join(outdir, 'dream_web_log.db'),
+        legacy_log = os.path.join(outdir, 'dream_web_log.txt'),
+    )
+    # requests are queued and run on the scheduler thread; with --batch_size
+    # greater than 1 (or 0 for auto) compatible requests share a batch
+    DreamServer.scheduler = RequestScheduler(
+        t2i,
+        max_batch_size = t2i.batch_size,
+    )
+    DreamServer.scheduler.start()
     dream_server = ThreadingDreamServer((host, port))
     print(">> Started Stable Diffusion dream server!")
     if host == '0.0.0.0':
@@ -424,6 +497,13 @@ def create_argv_parser():
         default=1,
         help='Number of images to generate',
     )
+    parser.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=1,
+        help='Number of images to sample together in one batch. Use 0 to choose the largest batch that fits in free memory',
+    )
     parser.add_argument(
         '-F',
         '--full_precision',
@@ -514,6 +594,30 @@ def create_argv_parser():
         default='9090',
         help='Web server: Port to listen on'
     )
+    parser.add_argument(
+        '--png_compression',
+        type=int,
+        default=6,
+        help='zlib compression level for PNG output, 0 (fastest, largest) to 9 (slowest, smallest). Default: 6',
+    )
+    parser.add_argument(
+        '--write_threads',
+        type=int,
+        default=2,
+        help='Number of background threads that encode and write image files',
+    )
+    parser.add_argument(
+        '--shard_size',
+        type=int,
+        default=None,
+        help='Write images into numbered subdirectories of the output directory, each holding at most this many image prefixes',
+    )
+    parser.add_argument(
+        '--intermediate_format',
+        choices=['png', 'webp', 'jpeg'],
+        default='png',
+        help='Web server: file format of the progress images. webp and jpeg are much quicker to write than png',
+    )
     parser.add_argument(
         '--weights',
         default='model',
@@ -536,6 +640,68 @@ def create_argv_parser():
         default='configs/models.yaml',
         help='Path to configuration file for alternate models.',
     )
+    parser.add_argument(
+        '--model_cache_gb',
+        type=float,
+        default=12.0,
+        help='Memory, in GB, that models loaded by !switch may take up before the least recently used are unloaded',
+    )
+    parser.add_argument(
+        '--attention',
+        choices=['auto', 'einsum', 'sliced', 'flash', 'sdp'],
+        default='auto',
+        help='How to compute attention. auto picks per call from the image size and --attention_memory_gb; sliced and flash use less memory; sdp needs a recent torch',
+    )
+    parser.add_argument(
+        '--attention_memory_gb',
+        type=float,
+        default=None,
+        help='Memory, in GB, that attention may use for its score matrices. Defaults to half the memory free when first measured',
+    )
+    parser.add_argument(
+        '--vae_tile_size',
+        type=int,
+        default=None,
+        help='Encode and decode images larger than this many pixels across in overlapping tiles, so large images need no more memory than one tile',
+    )
+    parser.add_argument(
+        '--vae_tile_overlap',
+        type=int,
+        default=64,
+        help='Pixels by which the --vae_tile_size tiles overlap and are blended. Default: 64',
+    )
+    parser.add_argument(
+        '--cfg_truncation',
+        type=float,
+        default=0.0,
+        help='Fraction of the final steps to run without the unconditional half of classifier free guidance, which halves their cost. Default: 0.0',
+    )
+    parser.add_argument(
+        '--postprocess_workers',
+        type=int,
+        default=1,
+        help='Threads that upscale and restore faces while the next images are sampled. Default: 1',
+    )
+    parser.add_argument(
+        '--profile_startup',
+        action='store_true',
+        help='Report the time taken by each module import and each part of model construction during startup',
+    )
+    parser.add_argument(
+        '--mmap_weights',
+        action='store_true',
+        help='Convert the .ckpt file once to a memory-mapped .safetensors copy, written beside it or under ~/.cache, and load that from then on',
+    )
+    parser.add_argument(
+        '--inference_snapshot',
+        action='store_true',
+        help='Load the inference snapshot exported beside the checkpoint in place of it. Its EMA weights give different images',
+    )
+    parser.add_argument(
+        '--keep_models_on_device',
+        action='store_true',
+        help='Keep models that are not in use on the GPU rather than moving them to CPU memory',
+    )
     return parser
 
 
@@ -558,6 +724,13 @@ def create_cmd_parser():
         default=1,
         help='Number of samplings to perform (slower, but will provide seeds for individual images)',
     )
+    parser.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=None,
+        help='Number of samplings to perform together in one batch (faster, uses more memory). 0 picks the largest batch that fits in free memory',
+    )
     parser.add_argument(
         '-W', '--width', type=int, help='Image width, multiple of 64'
     )
@@ -571,6 +744,11 @@ def create_cmd_parser():
         type=float,
         help='Classifier free guidance (CFG) scale - higher numbers cause generator to "try" harder.',
     )
+    parser.add_argument(
+        '--cfg_truncation',
+        type=float,
+        help='Fraction of the final steps to sample without classifier free guidance (faster). Overrides the value given at launch',
+    )
     parser.add_argument(
         '-g', '--grid', action='store_true', help='generate a grid'
     )
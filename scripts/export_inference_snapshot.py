@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Writes a model's weights as an inference snapshot: a memory-mapped file
+# holding only what sampling needs, in the dtype it will run in, with the
+# EMA weights swapped in and the stripped model config stored inside it.
+#
+# Written beside the checkpoint, the snapshot is loaded in place of it by
+# dream.py --inference_snapshot:
+#
+#   python scripts/export_inference_snapshot.py --model stable-diffusion-1.4
+#
+# Run it again after replacing the checkpoint; an older snapshot is ignored.
+import argparse
+import os
+import sys
+
+from omegaconf import OmegaConf
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export an inference snapshot of a model')
+    parser.add_argument(
+        '--model',
+        default='stable-diffusion-1.4',
+        help='Name of the model in --config to export. Default: stable-diffusion-1.4',
+    )
+    parser.add_argument(
+        '--config',
+        default='configs/models.yaml',
+        help='Configuration file listing the models. Default: configs/models.yaml',
+    )
+    parser.add_argument(
+        '--full_precision',
+        '-F',
+        action='store_true',
+        help='Export 32 bit weights, for use with dream.py --full_precision',
+    )
+    parser.add_argument(
+        '--no_ema',
+        action='store_true',
+        help='Keep the model weights even if the checkpoint has EMA weights',
+    )
+    parser.add_argument(
+        '--output',
+        '-o',
+        default=None,
+        help='Where to write the snapshot. Default: beside the checkpoint, where dream.py --inference_snapshot looks for it',
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.path.append('.')
+    from ldm.dream.flat_weights import export_inference_snapshot, inference_snapshot_path
+
+    models = OmegaConf.load(args.config)
+    if args.model not in models:
+        print(f'>> "{args.model}" is not a model in {args.config}')
+        sys.exit(-1)
+    entry  = models[args.model]
+    half   = not args.full_precision
+    output = args.output or inference_snapshot_path(entry.weights, half=half)
+    if os.path.abspath(output) == os.path.abspath(entry.weights):
+        print('>> The snapshot would overwrite the checkpoint; choose another --output')
+        sys.exit(-1)
+
+    print(f'>> Exporting {entry.weights} to {output}')
+    export_inference_snapshot(
+        OmegaConf.load(entry.config),
+        entry.weights,
+        output,
+        half    = half,
+        use_ema = not args.no_ema,
+    )
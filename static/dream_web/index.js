@@ -7,7 +7,7 @@ function toBase64(file) {
     });
 }
 
-function appendOutput(src, seed, config) {
+function appendOutput(src, seed, config, older=false) {
     let outputNode = document.createElement("figure");
     
     let variations = config.with_variations;
@@ -50,7 +50,11 @@ function appendOutput(src, seed, config) {
         saveFields(document.querySelector("#generate-form"));
     });
 
-    document.querySelector("#results").prepend(outputNode);
+    if (older) {
+        document.querySelector("#results").append(outputNode);
+    } else {
+        document.querySelector("#results").prepend(outputNode);
+    }
 }
 
 function saveFields(form) {
@@ -78,6 +82,21 @@ function clearFields(form) {
 }
 
 const BLANK_IMAGE_URL = 'data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg"/>';
+let currentJobId = null;
+let awaitingJobId = false;  // submitted, but the server hasn't said which job it is yet
+let cancelPending = false;
+
+function cancelJob() {
+    // only ever cancel our own request: a bare /cancel would cancel everyone's
+    if (currentJobId) {
+        fetch(`/cancel/${currentJobId}`).catch(e => {
+            console.error(e);
+        });
+    } else if (awaitingJobId) {
+        cancelPending = true;
+    }
+}
+
 async function generateSubmit(form) {
     const prompt = document.querySelector("#prompt").value;
 
@@ -99,6 +118,8 @@ async function generateSubmit(form) {
     progressImageEle.style.display = {}.hasOwnProperty.call(formData, 'progress_images') ? 'initial': 'none';
 
     // Post as JSON, using Fetch streaming to get results
+    awaitingJobId = true;
+    cancelPending = false;
     fetch(form.action, {
         method: form.method,
         body: JSON.stringify(formData),
@@ -110,6 +131,9 @@ async function generateSubmit(form) {
             let {value, done} = await reader.read();
             value = new TextDecoder().decode(value);
             if (done) {
+                currentJobId  = null;
+                awaitingJobId = false;
+                cancelPending = false;
                 progressSectionEle.style.display = 'none';
                 break;
             }
@@ -117,7 +141,14 @@ async function generateSubmit(form) {
             for (let event of value.split('\n').filter(e => e !== '')) {
                 const data = JSON.parse(event);
 
-                if (data.event === 'result') {
+                if (data.event === 'job') {
+                    currentJobId  = data.id;
+                    awaitingJobId = false;
+                    if (cancelPending) {
+                        cancelPending = false;
+                        cancelJob();
+                    }
+                } else if (data.event === 'result') {
                     noOutputs = false;
                     appendOutput(data.url, data.seed, data.config);
                     progressEle.setAttribute('value', 0);
@@ -135,6 +166,8 @@ async function generateSubmit(form) {
                 } else if (data.event === 'canceled') {
                     // avoid alerting as if this were an error case
                     noOutputs = false;
+                } else if (data.event === 'error') {
+                    console.error(data.message);
                 }
             }
         }
@@ -154,13 +187,27 @@ async function generateSubmit(form) {
     document.querySelector("#prompt").value = `Generating: "${prompt}"`;
 }
 
-async function fetchRunLog() {
+const RUN_LOG_PAGE_SIZE = 100;
+let oldestRunLogId = null;
+
+// loads the newest page of the run log, or with older=true the page before
+// the oldest one shown so far
+async function fetchRunLog(older=false) {
+    let url = `/run_log.json?limit=${RUN_LOG_PAGE_SIZE}`;
+    if (older && oldestRunLogId !== null) {
+        url += `&before=${oldestRunLogId}`;
+    }
     try {
-        let response = await fetch('/run_log.json')
+        let response = await fetch(url)
         const data = await response.json();
-        for(let item of data.run_log) {
-            appendOutput(item.url, item.seed, item);
+        let items = older ? data.run_log.slice().reverse() : data.run_log;
+        for(let item of items) {
+            appendOutput(item.url, item.seed, item, older);
+        }
+        if (data.first_id !== null) {
+            oldestRunLogId = data.first_id;
         }
+        document.querySelector("#load-more").style.display = data.more ? 'initial' : 'none';
     } catch (e) {
         console.error(e);
     }
@@ -195,19 +242,27 @@ window.onload = async () => {
     loadFields(document.querySelector("#generate-form"));
 
     document.querySelector('#cancel-button').addEventListener('click', () => {
-        fetch('/cancel').catch(e => {
-            console.error(e);
-        });
+        cancelJob();
     });
     document.documentElement.addEventListener('keydown', (e) => {
       if (e.key === "Escape")
-        fetch('/cancel').catch(err => {
-          console.error(err);
-        });
+        cancelJob();
     });
 
+    let modelEle = document.querySelector("#model");
+    for (let name of config.models) {
+        let option = document.createElement("option");
+        option.value = name;
+        option.textContent = name;
+        modelEle.append(option);
+    }
+    modelEle.value = localStorage.getItem('model') || '';
+
     if (!config.gfpgan_model_exists) {
         document.querySelector("#gfpgan").style.display = 'none';
     }
+    document.querySelector("#load-more").addEventListener('click', () => {
+        fetchRunLog(true);
+    });
     await fetchRunLog()
 };
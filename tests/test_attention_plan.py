@@ -0,0 +1,57 @@
+"""
+The attention plan for the shapes Stable Diffusion attends over, worked out
+from the shapes alone, so the plan for a device that isn't here can be
+checked too.
+
+    python -m pytest tests/test_attention_plan.py
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from ldm.modules.attention import MPS_MAX_SCORES, plan_attention
+
+HEADS  = 8
+BUDGET = 64 * 2**30   # enough to hold the whole score matrix at 1024px
+
+
+class ShapeOnly:
+    '''Just enough of a tensor for plan_attention(); no memory is allocated'''
+    def __init__(self, shape, device, dtype=torch.float32):
+        self.shape  = torch.Size(shape)
+        self.device = torch.device(device)
+        self.dtype  = dtype
+
+    def element_size(self):
+        return torch.empty((), dtype=self.dtype).element_size()
+
+
+def self_attention(pixels, device, images=2):
+    # images is 2 for one image, as classifier-free guidance runs it twice
+    tokens = (pixels // 8) ** 2
+    q = ShapeOnly([images * HEADS, tokens, 40], device)
+    return q, q
+
+
+def test_mps_1024px_is_sliced_under_the_matmul_limit():
+    q, k = self_attention(1024, 'mps')
+    backend, q_chunk, kv_chunk = plan_attention(q, k, budget=BUDGET)
+    assert backend == 'sliced'
+    assert q.shape[0] * q_chunk * kv_chunk <= MPS_MAX_SCORES
+
+
+def test_mps_512px_still_gets_the_whole_matrix():
+    q, k = self_attention(512, 'mps')
+    assert plan_attention(q, k, budget=BUDGET)[0] == 'einsum'
+
+
+def test_mps_goes_to_flash_when_rows_are_too_long():
+    q, k = self_attention(8192, 'mps')
+    backend, q_chunk, kv_chunk = plan_attention(q, k, budget=BUDGET)
+    assert backend == 'flash'
+    assert q.shape[0] * q_chunk * kv_chunk <= MPS_MAX_SCORES
+
+
+def test_cuda_1024px_is_not_capped():
+    q, k = self_attention(1024, 'cuda')
+    assert plan_attention(q, k, budget=BUDGET)[0] in ('sdp', 'einsum')
@@ -0,0 +1,88 @@
+"""
+An image sampled in a batch must be the one its seed gives on its own, for
+the samplers that add noise as they go. Runs on the CPU with a stand-in for
+the UNet, so no model weights are needed.
+
+    python -m pytest tests/test_seed_batching.py
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+K     = pytest.importorskip('k_diffusion')
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.ksampler import KSampler
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+
+SHAPE = [4, 8, 8]
+
+
+class StandInModel:
+    '''Just enough of LatentDiffusion for the samplers to run; rows don't interact'''
+    parameterization = 'eps'
+
+    def __init__(self, timesteps=1000):
+        betas = make_beta_schedule('linear', timesteps, linear_start=0.00085, linear_end=0.0120)
+        alphas_cumprod = torch.cumprod(1.0 - torch.tensor(betas), dim=0)
+        self.num_timesteps       = timesteps
+        self.device              = torch.device('cpu')
+        self.betas               = torch.tensor(betas, dtype=torch.float32)
+        self.alphas_cumprod      = alphas_cumprod.to(torch.float32)
+        self.alphas_cumprod_prev = torch.cat([torch.ones(1), alphas_cumprod[:-1]]).to(torch.float32)
+
+    def apply_model(self, x, t, cond=None):
+        return torch.tanh(x) * 0.5 + cond.mean() + t.float().reshape(-1, 1, 1, 1) / self.num_timesteps
+
+
+def sample(sampler, seeds, eta=0.0):
+    generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+    x_T = torch.cat([torch.randn([1, *SHAPE], generator=g) for g in generators])
+    samples, _ = sampler.sample(
+        S            = 10,
+        batch_size   = len(seeds),
+        shape        = SHAPE,
+        conditioning = torch.zeros(len(seeds), 1, 8),
+        x_T          = x_T,
+        eta          = eta,
+        verbose      = False,
+        generator    = generators,
+    )
+    return samples
+
+
+def assert_batch_matches_alone(sampler, eta=0.0):
+    alone   = sample(sampler, [42], eta)
+    batched = sample(sampler, [7, 42, 1234], eta)
+    assert torch.allclose(batched[1:2], alone, atol=1e-5)
+    assert not torch.allclose(batched[0:1], alone, atol=1e-5)
+
+
+@pytest.mark.parametrize('schedule', ['euler_ancestral', 'dpm_2_ancestral'])
+def test_ancestral_ksampler_batch_matches_alone(schedule):
+    assert_batch_matches_alone(KSampler(StandInModel(), schedule, device='cpu'))
+
+
+def old_style_euler_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    # as in k-diffusion releases without noise_sampler: the noise comes from torch.randn_like()
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    for i in range(len(sigmas) - 1):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        sigma_down, sigma_up = K.sampling.get_ancestral_step(sigmas[i], sigmas[i + 1])
+        d = K.sampling.to_d(x, sigmas[i], denoised)
+        x = x + d * (sigma_down - sigmas[i])
+        x = x + torch.randn_like(x) * sigma_up
+    return x
+
+
+def test_ksampler_without_noise_sampler_leaves_global_rng_alone(monkeypatch):
+    monkeypatch.setitem(K.sampling.__dict__, 'sample_old_style', old_style_euler_ancestral)
+    sampler = KSampler(StandInModel(), 'old_style', device='cpu')
+    torch.manual_seed(0)
+    state = torch.get_rng_state()
+    assert_batch_matches_alone(sampler)
+    assert torch.equal(torch.get_rng_state(), state)
+
+
+def test_ddim_with_eta_batch_matches_alone():
+    assert_batch_matches_alone(DDIMSampler(StandInModel(), device='cpu'), eta=1.0)